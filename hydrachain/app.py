@@ -13,7 +13,6 @@ from click.types import IntRange
 from devp2p.app import BaseApp
 from devp2p.crypto import privtopub as privtopub_raw
 from devp2p.discovery import NodeDiscovery
-from devp2p.peermanager import PeerManager
 from devp2p.service import BaseService
 from devp2p.utils import host_port_pubkey_to_uri
 from ethereum.keys import privtoaddr, PBKDF2_CONSTANTS
@@ -23,10 +22,11 @@ from pyethapp.accounts import AccountsService, Account
 from pyethapp.accounts import mk_privkey
 from pyethapp.console_service import Console
 from pyethapp.db_service import DBService
-from pyethapp.jsonrpc import JSONRPCServer
 
 from hydrachain import __version__
+from hydrachain.consensus.protocol import HDCPeerManager
 from hydrachain.hdc_service import ChainService
+from hydrachain.rpc import JSONRPCServer
 
 
 log = slogging.get_logger('app')
@@ -35,7 +35,7 @@ log = slogging.get_logger('app')
 services = [DBService,
             AccountsService,
             NodeDiscovery,
-            PeerManager,
+            HDCPeerManager,
             ChainService,
             JSONRPCServer,
             Console]
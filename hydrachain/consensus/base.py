@@ -1,17 +1,21 @@
 # Copyright (c) 2015 Heiko Hees
 
-from collections import Counter
+import threading
+from collections import Counter, OrderedDict
 
+import gevent.threadpool
 from bitcoin.main import encode_privkey
 from ethereum.blocks import Block
+from ethereum.db import EphemDB
+from ethereum.trie import Trie
 from ethereum.utils import big_endian_to_int, zpad, int_to_32bytearray
 from bitcoin import encode_pubkey, N, P
 import rlp
 from rlp.sedes import big_endian_int, binary
-from rlp.sedes import CountableList
+from rlp.sedes import CountableList, List
 from rlp.utils import encode_hex
 from ethereum.blocks import BlockHeader
-from ethereum.transactions import Transaction
+from ethereum.transactions import Transaction, UnsignedTransaction
 from secp256k1 import PrivateKey, PublicKey, ALL_FLAGS
 
 from hydrachain.utils import sha3, phx
@@ -55,8 +59,133 @@ class MissingSignatureError(Exception):
     pass
 
 
+class SenderCache(object):
+
+    """
+    Bounded LRU cache of recovered senders keyed by (rawhash, v, r, s).
+
+    The same vote is decoded many times: from every peer, within the locksets
+    of proposals and Ready messages and again in sync batches.
+    """
+
+    def __init__(self, max_items=8192):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                sender = self.cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.cache[key] = sender  # most recently used last
+            self.hits += 1
+            return sender
+
+    def put(self, key, sender):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = sender
+            if len(self.cache) > self.max_items:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __repr__(self):
+        return '<SenderCache(size=%d hits=%d misses=%d)>' % (len(self), self.hits, self.misses)
+
+
+sender_cache = SenderCache()  # process wide
+
+
+class Secp256k1Contexts(object):
+
+    """
+    libsecp256k1 context shared by all Signed messages.
+
+    Creating a context (and its precomputed tables) is far more expensive than
+    signing or recovering. Contexts are read only once created, so they can be
+    used from any thread. The bindings require ALL_FLAGS for recovery, so one
+    context serves signing and verification.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._owner = None
+
+    @property
+    def ctx(self):
+        with self.lock:
+            if self._owner is None:
+                self._owner = PublicKey(flags=ALL_FLAGS)  # owns and destroys the context
+            return self._owner.ctx
+
+    def private_key(self, privkey):
+        "privkey: 32 bytes binary or 64 hex encoded"
+        if privkey in (0, '', '\x00' * 32):
+            raise InvalidSignature("Zero privkey cannot sign")
+        if len(privkey) == 64:
+            privkey = encode_privkey(privkey, 'bin')
+        return PrivateKey(privkey, raw=True, ctx=self.ctx)
+
+    def public_key(self):
+        return PublicKey(flags=ALL_FLAGS, ctx=self.ctx)
+
+
+contexts = Secp256k1Contexts()
+
+
+def recover_address(rawhash, v, r, s):
+    "raises InvalidSignature, safe to be called from any thread"
+    pk = contexts.public_key()
+    try:
+        pk.public_key = pk.ecdsa_recover(
+            rawhash,
+            pk.ecdsa_recoverable_deserialize(
+                zpad(
+                    "".join(chr(c) for c in int_to_32bytearray(r)),
+                    32
+                ) + zpad(
+                    "".join(chr(c) for c in int_to_32bytearray(s)),
+                    32
+                ),
+                v - 27
+            ),
+            raw=True
+        )
+        pub = pk.serialize(compressed=False)
+    except Exception:
+        raise InvalidSignature()
+    if pub[1:] == "\x00" * 32:
+        raise InvalidSignature()
+    pub = encode_pubkey(pub, 'bin')
+    return sha3(pub[1:])[-20:]
+
+
 class Signed(RLPHashable):
 
+    """
+    Base for signed messages.
+
+    The rawhash (hash of the unsigned message), the hash and the rlp encoding are
+    computed once and cached. Setting a field drops the caches, changing the content
+    also drops the sender. Nested objects (e.g. locksets) must not be changed once
+    the message is signed, as the caches hold the signed state.
+    """
+
     fields = [
         ('v', big_endian_int),
         ('r', big_endian_int),
@@ -64,24 +193,96 @@ class Signed(RLPHashable):
     ]
 
     _sender = None
+    _rawhash = None
+    _hash = None
+    _rlp = None
+    _payload_hash = None  # of the wire payload, if received from a peer
+    _payloads = None  # encoded wire payloads, see protocol.message_command
 
     def __init__(self, *args, **kargs):
         super(Signed, self).__init__(*args, **kargs)
 
-    def sign(self, privkey):
-        """Sign this with a private key"""
+    def __setattr__(self, attr, value):
+        super(Signed, self).__setattr__(attr, value)
+        if attr in ('v', 'r', 's'):
+            self.__dict__.update(_rlp=None, _payloads=None, _payload_hash=None)
+        elif not attr.startswith('_'):
+            self.__dict__.update(_rlp=None, _payloads=None, _payload_hash=None,
+                                 _rawhash=None, _hash=None, _sender=None)
+
+    def _get_cached_rlp(self):
+        """
+        used by rlp.encode, also if it is called with another sedes (e.g. for the rawhash),
+        so this only returns the encoding set by encode or rlp.decode
+        """
+        return self._rlp
+
+    def _set_cached_rlp(self, data):
+        self._rlp = data
+
+    _cached_rlp = property(_get_cached_rlp, _set_cached_rlp)
+
+    def encode(self):
+        "the rlp encoding, signed messages are encoded only once"
+        if self._rlp is not None:
+            return self._rlp
+        data = rlp.encode(self)
         if self.v:
-            raise InvalidSignature("already signed")
+            self._rlp = data
+        return data
+
+    @classmethod
+    def get_sedes(cls):
+        # rlp stores the sedes on the class, don't inherit the one of a base class
+        if not cls.__dict__.get('_sedes'):
+            cls._sedes = List(sedes for _, sedes in cls.fields)
+        return cls._sedes
+
+    @classmethod
+    def _unsigned_sedes(cls):
+        if '_unsigned' not in cls.__dict__:
+            cls._unsigned = cls.exclude(['v', 'r', 's'])
+        return cls.__dict__['_unsigned']
+
+    @classmethod
+    def compact_sedes(cls):
+        "sedes which encodes the contained LockSets with CompactLockSet"
+        if '_compact' not in cls.__dict__:
+            class CompactSerializable(rlp.Serializable):
+                fields = [(field, CompactLockSet if sedes is LockSet else sedes)
+                          for field, sedes in cls.fields]
+                _sedes = None
+            cls._compact = CompactSerializable
+        return cls.__dict__['_compact']
+
+    @classmethod
+    def _hash_sedes(cls):
+        if '_hashable' not in cls.__dict__:
+            class HashSerializable(rlp.Serializable):
+                fields = [(field, sedes) for field, sedes in cls.fields
+                          if field not in ('v', 'r', 's')] + [('_sender', binary)]
+                _sedes = None
+            cls._hashable = HashSerializable
+        return cls.__dict__['_hashable']
 
-        if privkey in (0, '', '\x00' * 32):
-            raise InvalidSignature("Zero privkey cannot sign")
-        rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
+    @property
+    def rawhash(self):
+        "hash of the unsigned message"
+        if self._rawhash is None:
+            self._rawhash = sha3(rlp.encode(self, self._unsigned_sedes()))
+        return self._rawhash
 
-        if len(privkey) == 64:
-            privkey = encode_privkey(privkey, 'bin')
+    def sign(self, privkey):
+        """Sign this with a private key (binary, hex or a secp256k1.PrivateKey)"""
+        if self.v:
+            raise InvalidSignature("already signed")
 
-        pk = PrivateKey(privkey, raw=True)
-        signature = pk.ecdsa_recoverable_serialize(pk.ecdsa_sign_recoverable(rawhash, raw=True))
+        if isinstance(privkey, PrivateKey):
+            pk = privkey
+        else:
+            pk = contexts.private_key(privkey)
+        signature = pk.ecdsa_recoverable_serialize(
+            pk.ecdsa_sign_recoverable(self.rawhash, raw=True))
 
         signature = signature[0] + chr(signature[1])
 
@@ -90,6 +291,7 @@ class Signed(RLPHashable):
         self.s = big_endian_to_int(signature[32:64])
 
         self._sender = None
+        self._hash = None
         return self
 
     @property
@@ -98,48 +300,31 @@ class Signed(RLPHashable):
             self._sender = self.recover_sender()
         return self._sender
 
+    def sender_key(self):
+        "(rawhash, v, r, s) which identifies the signature"
+        if self.r >= N or self.s >= P or self.v < 27 or self.v > 28 \
+           or self.r == 0 or self.s == 0:
+            raise InvalidSignature()
+        return (self.rawhash, self.v, self.r, self.s)
+
     def recover_sender(self):
         if self.v:
-            if self.r >= N or self.s >= P or self.v < 27 or self.v > 28 \
-               or self.r == 0 or self.s == 0:
-                raise InvalidSignature()
-            rlpdata = rlp.encode(self, self.__class__.exclude(['v', 'r', 's']))
-            rawhash = sha3(rlpdata)
-            pk = PublicKey(flags=ALL_FLAGS)
-            try:
-                pk.public_key = pk.ecdsa_recover(
-                    rawhash,
-                    pk.ecdsa_recoverable_deserialize(
-                        zpad(
-                            "".join(chr(c) for c in int_to_32bytearray(self.r)),
-                            32
-                        ) + zpad(
-                            "".join(chr(c) for c in int_to_32bytearray(self.s)),
-                            32
-                        ),
-                        self.v - 27
-                    ),
-                    raw=True
-                )
-                pub = pk.serialize(compressed=False)
-            except Exception:
-                raise InvalidSignature()
-            if pub[1:] == "\x00" * 32:
-                raise InvalidSignature()
-            pub = encode_pubkey(pub, 'bin')
-            return sha3(pub[1:])[-20:]
+            key = self.sender_key()
+            sender = sender_cache.get(key)
+            if sender:
+                return sender
+            sender = recover_address(*key)
+            sender_cache.put(key, sender)
+            return sender
 
     @property
     def hash(self):
         "signatures are non deterministic"
-        if self.sender is None:
-            raise MissingSignatureError()
-
-        class HashSerializable(rlp.Serializable):
-            fields = [(field, sedes) for field, sedes in self.fields
-                      if field not in ('v', 'r', 's')] + [('_sender', binary)]
-            _sedes = None
-        return sha3(rlp.encode(self, HashSerializable))
+        if self._hash is None:
+            if self.sender is None:
+                raise MissingSignatureError()
+            self._hash = sha3(rlp.encode(self, self._hash_sedes()))
+        return self._hash
 
 # Votes
 
@@ -200,13 +385,31 @@ class LockSet(RLPHashable):  # careful, is mutable!
     ]
 
     processed = False
+    _hash = None
+    _rlp = None
+    _decoded_compact = False
 
     def __init__(self, num_eligible_votes, votes=None):
         self.num_eligible_votes = num_eligible_votes
-        self.votes = []
-        for v in votes or []:
+        self.votes = votes or []
+
+    def _get_votes(self):
+        return self._votes.values()  # in insertion order
+
+    def _set_votes(self, votes):
+        verify_senders(votes)  # may yield, so before the state is reset
+        self._votes = OrderedDict()  # sender: vote
+        # running tally, updated in add
+        self._hr = None
+        self._tally = Counter()  # blockhash: num votes
+        self._leader = None  # (blockhash, num votes) ranked first in blockhashes
+        self._blockhashes = None
+        self._hash = self._cached_rlp = None
+        for v in votes:
             self.add(v)
 
+    votes = property(_get_votes, _set_votes)
+
     # @property
     # def size(self):
     #     return len(self.votes) * 67 + 5
@@ -229,7 +432,7 @@ class LockSet(RLPHashable):  # careful, is mutable!
         return '%s:%d' % (s, len(self))
 
     def __repr__(self):
-        if self.votes:
+        if self._votes:
             return '<LockSet(%s H:%d R:%d)>' % (self.state, self.height, self.round)
         return '<LockSet(I:0)>'
 
@@ -237,43 +440,95 @@ class LockSet(RLPHashable):  # careful, is mutable!
         assert isinstance(vote, Vote)
         if not vote.sender:
             raise InvalidVoteError('no signature')
-        if vote not in self.votes:
+        if vote not in self:
             if len(self) and self.hr != vote.hr:
                 raise InvalidVoteError('inconsistent height, round')
-            signee = self.signee
-            if vote.sender in signee:
+            replaced = self._votes.get(vote.sender)
+            if replaced is not None:
                 if not force_replace:
                     raise DoubleVotingError(vote.sender)  # different votes on the same H,R
-                self.votes.remove(self.votes[signee.index(vote.sender)])
-            self.votes.append(vote)
+                del self._votes[vote.sender]  # the replacement is appended
+                self._uncount(replaced)
+            self._votes[vote.sender] = vote
+            self._hr = vote.hr
+            self._count(vote)
+            self._hash = self._cached_rlp = None  # encoding changed
             return True
 
+    def _count(self, vote):
+        self._blockhashes = None
+        if isinstance(vote, VoteBlock):
+            bh = vote.blockhash
+            self._tally[bh] += 1
+            n = self._tally[bh]
+            if not self._leader or (n, bh) > (self._leader[1], self._leader[0]):
+                self._leader = (bh, n)
+
+    def _uncount(self, vote):
+        self._blockhashes = None
+        if isinstance(vote, VoteBlock):
+            self._tally[vote.blockhash] -= 1
+            if not self._tally[vote.blockhash]:
+                del self._tally[vote.blockhash]
+            self._leader = None
+            for bh, n in self._tally.items():
+                if not self._leader or (n, bh) > (self._leader[1], self._leader[0]):
+                    self._leader = (bh, n)
+
     def __len__(self):
-        return len(self.votes)
+        return len(self._votes)
 
     def __iter__(self):
         return iter(self.votes)
 
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = super(LockSet, self).hash
+        return self._hash
+
+    def _get_cached_rlp(self):
+        return self._rlp
+
+    def _set_cached_rlp(self, data):
+        # rlp.decode caches the decoded data, which is not our encoding if it was compact
+        if not self._decoded_compact:
+            self._rlp = data
+
+    _cached_rlp = property(_get_cached_rlp, _set_cached_rlp)
+
+    def __contains__(self, vote):
+        "same as comparing the hashes, but without encoding the votes"
+        if not isinstance(vote, Vote) or not vote.sender:
+            return False
+        known = self._votes.get(vote.sender)
+        return known is not None and known.hr == vote.hr and known.blockhash == vote.blockhash
+
     @property
     def signee(self):
-        return [v.sender for v in self.votes]
+        return self._votes.keys()
 
     def blockhashes(self):
         assert self.is_valid
-        c = Counter(v.blockhash for v in self.votes if isinstance(v, VoteBlock))
-        # deterministc sort necessary
-        return sorted(c.most_common(), cmp=lambda a, b: cmp((b[1], b[0]), (a[1], a[0])))
+        if self._blockhashes is None:
+            # deterministc sort necessary
+            self._blockhashes = sorted(self._tally.items(),
+                                       key=lambda x: (x[1], x[0]), reverse=True)
+        return list(self._blockhashes)
+
+    @property
+    def leader(self):
+        "(blockhash, num votes) with the most votes or None"
+        return self._leader
 
     @property
     def hr(self):
-        """compute (height,round)
+        """(height,round) of the votes, all votes must share it
         We might have multiple rounds before we see consensus for a certain height.
         If everything is good, round should always be 0.
         """
         assert len(self), 'no votes, can not determine height'
-        h = set([(v.height, v.round) for v in self.votes])
-        assert len(h) == 1, len(h)
-        return h.pop()
+        return self._hr
 
     height = property(lambda self: self.hr[0])
     round = property(lambda self: self.hr[1])
@@ -289,9 +544,8 @@ class LockSet(RLPHashable):  # careful, is mutable!
         there is a quorum.
         """
         assert self.is_valid
-        bhs = self.blockhashes()
-        if bhs and bhs[0][1] > 2 / 3. * self.num_eligible_votes:
-            return bhs[0][0]
+        if self._leader and self._leader[1] > 2 / 3. * self.num_eligible_votes:
+            return self._leader[0]
 
     @property
     def has_noquorum(self):
@@ -299,8 +553,7 @@ class LockSet(RLPHashable):  # careful, is mutable!
         less than 1/3 of the known votes are on the same block
         """
         assert self.is_valid
-        bhs = self.blockhashes()
-        if not bhs or bhs[0][1] <= 1 / 3. * self.num_eligible_votes:
+        if not self._leader or self._leader[1] <= 1 / 3. * self.num_eligible_votes:
             assert not self.has_quorum_possible
             return True
 
@@ -314,9 +567,8 @@ class LockSet(RLPHashable):  # careful, is mutable!
         if self.has_quorum:
             return
         assert self.is_valid  # we could tell that earlier
-        bhs = self.blockhashes()
-        if bhs and bhs[0][1] > 1 / 3. * self.num_eligible_votes:
-            return bhs[0][0]
+        if self._leader and self._leader[1] > 1 / 3. * self.num_eligible_votes:
+            return self._leader[0]
 
     def check(self):
         "either invalid or one of quorum, noquorum, quorumpossible"
@@ -326,6 +578,159 @@ class LockSet(RLPHashable):  # careful, is mutable!
         assert 1 == len([x for x in test if x is not None])
         return True
 
+    @classmethod
+    def deserialize(cls, serial, **kargs):
+        "accepts the default and the CompactLockSet format"
+        if len(serial) == len(CompactLockSet.sedes):
+            return CompactLockSet.deserialize(serial)
+        return super(LockSet, cls).deserialize(serial, **kargs)
+
+
+class CompactLockSet(object):
+
+    """
+    Sedes for LockSets which does not repeat height, round and blockhash in every vote:
+
+        [num_eligible_votes, height, round, [blockhash, ...], [[i, r, s], ...]]
+
+    with i = 2 * b + v - 27, where b is the 1-based index of the vote's blockhash
+    (0 for VoteNil). Votes are kept in order, so the LockSet is restored as it was.
+    """
+
+    sedes = List([big_endian_int, big_endian_int, big_endian_int,
+                  CountableList(binary), CountableList(List([big_endian_int] * 3))])
+
+    @classmethod
+    def serialize(cls, ls):
+        h, r = ls.hr if len(ls) else (0, 0)
+        blockhashes, indexes, votes = [], dict(), []
+        for v in ls:
+            b = 0
+            if isinstance(v, VoteBlock):
+                if v.blockhash not in indexes:
+                    blockhashes.append(v.blockhash)
+                    indexes[v.blockhash] = len(blockhashes)
+                b = indexes[v.blockhash]
+            votes.append([2 * b + v.v - 27, v.r, v.s])
+        return cls.sedes.serialize([ls.num_eligible_votes, h, r, blockhashes, votes])
+
+    @classmethod
+    def deserialize(cls, serial):
+        num_eligible_votes, h, r, blockhashes, signatures = cls.sedes.deserialize(serial)
+        blockhashes = [''] + list(blockhashes)
+        votes = []
+        for i, vr, vs in signatures:
+            if i // 2 >= len(blockhashes):
+                raise rlp.DeserializationError('invalid blockhash index', serial)
+            v = Vote(h, r, blockhashes[i // 2], i % 2 + 27, vr, vs)
+            v._mutable = False
+            votes.append(v)
+        ls = LockSet(num_eligible_votes, votes)
+        ls._mutable = False
+        ls._decoded_compact = True
+        return ls
+
+
+# batch verification
+
+
+def signed_messages(objs):
+    "yields all Signed objects and Transactions in objs, including the votes in their locksets"
+    for o in objs:
+        if isinstance(o, Transaction):
+            yield o
+        elif isinstance(o, LockSet):
+            for v in o.votes:
+                yield v
+        elif isinstance(o, Signed):
+            yield o
+            for field, sedes in o.fields:
+                if sedes is LockSet:
+                    for v in getattr(o, field).votes:
+                        yield v
+        elif isinstance(o, (list, tuple)):
+            for m in signed_messages(o):
+                yield m
+
+
+def transaction_sender_key(tx):
+    "like Signed.sender_key for a Transaction"
+    if tx.r >= N or tx.s >= N or tx.v < 27 or tx.v > 28 or tx.r == 0 or tx.s == 0:
+        raise InvalidSignature()
+    return (sha3(rlp.encode(tx, UnsignedTransaction)), tx.v, tx.r, tx.s)
+
+
+def _recover_address(key):
+    try:
+        return recover_address(*key)
+    except InvalidSignature:
+        return None
+
+
+class BatchVerifier(object):
+
+    """
+    Recovers the senders of a whole batch of messages (e.g. all votes of a LockSet)
+    or transactions at once and writes them back into `_sender`.
+
+    Uncached signatures are recovered on a pool of OS threads, libsecp256k1 is called
+    via cffi which releases the GIL. The call is synchronous for the calling greenlet.
+    Invalid signatures are left unresolved, so accessing `.sender` raises as usual.
+
+    While the pool recovers a batch the calling greenlet yields, i.e. other messages
+    are handled meanwhile. Callers therefore verify before they change any state and
+    check the state afterwards. Batches below min_batch_size are recovered inline and
+    do not yield.
+    """
+
+    num_workers = 4
+    min_batch_size = 8  # smaller batches are not worth the thread switches
+
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers or self.num_workers
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = gevent.threadpool.ThreadPool(self.num_workers)
+        return self._pool
+
+    def verify(self, objs):
+        "returns the number of recovered signatures"
+        pending = OrderedDict()  # key: [messages]
+        for m in signed_messages(objs):
+            if m._sender or not m.v:
+                continue
+            try:
+                key = transaction_sender_key(m) if isinstance(m, Transaction) else m.sender_key()
+            except InvalidSignature:
+                continue
+            sender = sender_cache.get(key)
+            if sender:
+                m._sender = sender
+            else:
+                pending.setdefault(key, []).append(m)
+        keys = pending.keys()
+        if len(keys) < self.min_batch_size:
+            senders = [_recover_address(k) for k in keys]
+        else:
+            senders = self.pool.map(_recover_address, keys)
+        for key, sender in zip(keys, senders):
+            if sender:
+                sender_cache.put(key, sender)
+                for m in pending[key]:
+                    m._sender = sender
+        return len(keys)
+
+
+batch_verifier = BatchVerifier()
+
+
+def verify_senders(*objs):
+    "recover the senders of all messages and votes in objs, may yield, see BatchVerifier"
+    return batch_verifier.verify(objs)
+
 ############
 
 
@@ -375,21 +780,63 @@ class HDCBlock(Block):
     pass
 
 
+def transactions_root(transactions):
+    "root of the transaction trie, as built by Block"
+    t = Trie(EphemDB())
+    for i, tx in enumerate(transactions):
+        t.update(rlp.encode(i), rlp.encode(tx))
+    return t.root_hash
+
+
 class TransientBlock(rlp.Serializable):
 
-    """A partially decoded, unvalidated block."""
+    """A partially decoded, unvalidated block.
+
+    If deserialized, the transactions are only decoded when accessed (e.g. in to_block),
+    until then the serialized transactions are used to encode the block.
+    """
 
     fields = [
         ('header', HDCBlockHeader),
         ('transaction_list', rlp.sedes.CountableList(Transaction)),
         ('uncles', rlp.sedes.CountableList(BlockHeader))
     ]
+    _lazy_sedes = List([HDCBlockHeader, CountableList(rlp.sedes.raw),
+                        CountableList(BlockHeader)])
+    _transactions_serial = None
 
     def __init__(self, header, transaction_list, uncles):
         self.header = header
         self.transaction_list = transaction_list
         self.uncles = uncles
 
+    def _get_transaction_list(self):
+        if self._transactions_serial is not None:
+            self._transaction_list = self.fields[1][1].deserialize(self._transactions_serial)
+            self._transactions_serial = None
+        return self._transaction_list
+
+    def _set_transaction_list(self, transaction_list):
+        self._transaction_list = transaction_list
+        self._transactions_serial = None
+
+    transaction_list = property(_get_transaction_list, _set_transaction_list)
+
+    @classmethod
+    def deserialize(cls, serial, **kargs):
+        header, transactions, uncles = cls._lazy_sedes.deserialize(serial)
+        obj = cls(header, (), uncles)
+        obj._transactions_serial = transactions
+        obj._mutable = False
+        return obj
+
+    @classmethod
+    def serialize(cls, obj):
+        transactions = getattr(obj, '_transactions_serial', None)
+        if transactions is None:
+            return super(TransientBlock, cls).serialize(obj)
+        return cls._lazy_sedes.serialize([obj.header, transactions, obj.uncles])
+
     def to_block(self, env, parent=None):
         """Convert the transient block to a :class:`ethereum.blocks.Block`"""
         return Block(self.header, self.transaction_list, self.uncles, env=env, parent=parent)
@@ -465,7 +912,6 @@ class BlockProposal(Proposal):
         if self.round_lockset and not round_lockset.has_noquorum:
             raise InvalidProposalError('at R>0 can only propose if there is a NoQuorum for R-1')
 
-        self.rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
         if self.v:  # validate sender == block.coinbase
             assert self.sender
 
@@ -473,16 +919,31 @@ class BlockProposal(Proposal):
     def lockset(self):
         return self.round_lockset or self.signing_lockset
 
+    _compact_proposal = None  # CompactBlockProposal sent to peers supporting it
+
+    def __setattr__(self, attr, value):
+        super(BlockProposal, self).__setattr__(attr, value)
+        if not attr.startswith('_'):
+            self.__dict__['_compact_proposal'] = None
+
+    def set_linked_block(self, block):
+        "replace the block with the one linked to the chain, the cached encodings stay valid"
+        assert isinstance(block, Block)
+        assert block.hash == self.block.hash
+        caches = dict((k, self.__dict__.get(k)) for k in ('_rlp', '_rawhash', '_hash', '_sender',
+                                                          '_payloads', '_payload_hash',
+                                                          '_compact_proposal'))
+        self._mutable = True
+        self.block = block
+        self.__dict__.update(caches)
+
     @property
     def sender(self):
-        # double check unmutable
+        # changing the content after signing drops the cached sender and rawhash
         s = super(BlockProposal, self).sender
         if not s:
             raise InvalidProposalError('signature missing')
-        assert self.rawhash
         assert self.v
-        _rawhash = sha3(rlp.encode(self, self.__class__.exclude(['v', 'r', 's'])))
-        assert self.rawhash == _rawhash
         assert len(s) == 20
         assert len(self.block.header.coinbase) == 20
         if s != self.block.header.coinbase:
@@ -511,7 +972,7 @@ class BlockProposal(Proposal):
         return True
 
     def __repr__(self):
-        return "<%s S:%r H:%d R:%d BH:%s>" % (self.__class__.__name__, phx(self._sender),
+        return "<%s S:%r H:%d R:%d BH:%s>" % (self.__class__.__name__, phx(self.sender),
                                               self.height, self.round, phx(self.blockhash))
 
     @property
@@ -519,6 +980,70 @@ class BlockProposal(Proposal):
         return self.block.hash
 
 
+class CompactBlockProposal(rlp.Serializable):
+
+    """
+    Wire format of a BlockProposal which references the transactions of the block by hash.
+
+    Only the transactions the receivers are expected to lack are included, the others
+    are looked up in the receiver's pool. The signature is the one of the BlockProposal,
+    it is verified once the proposal is rebuilt.
+    """
+
+    fields = [
+        ('height', big_endian_int),
+        ('round', big_endian_int),
+        ('header', HDCBlockHeader),
+        ('transaction_hashes', CountableList(binary)),
+        ('transactions', CountableList(Transaction)),
+        ('uncles', CountableList(BlockHeader)),
+        ('signing_lockset', CompactLockSet),
+        ('round_lockset', CompactLockSet)
+    ] + Signed.fields
+
+    _payload_hash = None  # see Signed
+    _payloads = None
+
+    @classmethod
+    def compact_sedes(cls):
+        "LockSets are always encoded with CompactLockSet"
+        return cls
+
+    @classmethod
+    def from_proposal(cls, proposal, is_known=lambda txhash: False):
+        "includes the transactions for which is_known(tx.hash) is False"
+        blk = proposal.block
+        txs = blk.transaction_list
+        return cls(proposal.height, proposal.round, blk.header, [tx.hash for tx in txs],
+                   [tx for tx in txs if not is_known(tx.hash)], blk.uncles,
+                   proposal.signing_lockset, proposal.round_lockset,
+                   proposal.v, proposal.r, proposal.s)
+
+    @property
+    def blockhash(self):
+        return self.header.hash
+
+    def missing_transactions(self, pool):
+        "hashes of the transactions which are neither included nor in pool"
+        included = set(tx.hash for tx in self.transactions)
+        return [h for h in self.transaction_hashes if h not in included and h not in pool]
+
+    def to_proposal(self, pool):
+        "the BlockProposal, pool maps tx hashes to the transactions which are not included"
+        txs = dict((tx.hash, tx) for tx in self.transactions)
+        transactions = [txs[h] if h in txs else pool[h] for h in self.transaction_hashes]
+        if transactions_root(transactions) != self.header.tx_list_root:
+            raise InvalidProposalError('transactions do not match the tx_list_root')
+        block = TransientBlock(self.header, transactions, self.uncles)
+        return BlockProposal(self.height, self.round, block, self.signing_lockset,
+                             self.round_lockset or None, self.v, self.r, self.s)
+
+    def __repr__(self):
+        return '<%s(H:%d R:%d blockhash:%s txs:%d/%d)>' % (
+            self.__class__.__name__, self.height, self.round, phx(self.blockhash),
+            len(self.transactions), len(self.transaction_hashes))
+
+
 class VotingInstruction(Proposal):
 
     fields = [
@@ -1,9 +1,10 @@
 # Copyright (c) 2015 Heiko Hees
+import bisect
 import sys
 import rlp
 from .base import LockSet, Vote, VoteBlock, VoteNil, Signed, Ready
 from .base import BlockProposal, VotingInstruction, DoubleVotingError, InvalidVoteError
-from .base import Block, Proposal, HDCBlockHeader, InvalidProposalError
+from .base import Block, Proposal, HDCBlockHeader, InvalidProposalError, verify_senders
 from .protocol import HDCProtocol
 from .utils import cstr, phx
 from .synchronizer import Synchronizer
@@ -13,21 +14,102 @@ log = get_logger('hdc.consensus')
 
 class ManagerDict(object):
 
+    """
+    Creates the managers for heights or rounds on access.
+    The keys are kept in a sorted list, so inserting and popping are O(n) list moves.
+    That's cheap for the number of keys there are: heights below the head are pruned
+    by ConsensusManager.cleanup, votes from peers beyond max_future_heights and
+    max_future_rounds are dropped, so there are at most about a thousand keys.
+    New keys are usually the highest, so insort rarely moves anything. A heap would not
+    give the sorted iteration __iter__ needs.
+    """
+
     def __init__(self, dklass, parent):
         self.d = dict()
+        self.keys = []  # sorted
         self.dklass = dklass
         self.parent = parent
 
     def __getitem__(self, k):
         if k not in self.d:
             self.d[k] = self.dklass(self.parent, k)
+            bisect.insort(self.keys, k)
         return self.d[k]
 
     def __iter__(self):
-        return iter(sorted(self.d, reverse=True))
+        "highest key first, the manager may be modified while iterating"
+        return iter(self.keys[::-1])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, k):
+        return k in self.d
+
+    def get(self, k):
+        "returns the manager without creating it"
+        return self.d.get(k)
 
     def pop(self, k):
         self.d.pop(k)
+        del self.keys[bisect.bisect_left(self.keys, k)]
+
+
+class BlockCandidates(object):
+
+    """
+    BlockProposals which are not committed yet, by blockhash.
+    They are indexed by the hash of their parent and by height, so the candidates
+    following the head and those which are outdated are found without a scan.
+    """
+
+    def __init__(self):
+        self.proposals = dict()  # blockhash: BlockProposal
+        self.by_parent = dict()  # prevhash: set([blockhash, ...])
+        self.by_height = dict()  # height: set([blockhash, ...])
+        self.heights = []  # sorted
+
+    def __len__(self):
+        return len(self.proposals)
+
+    def __contains__(self, blockhash):
+        return blockhash in self.proposals
+
+    def get(self, blockhash):
+        return self.proposals.get(blockhash)
+
+    def values(self):
+        return self.proposals.values()
+
+    def add(self, p):
+        if p.blockhash in self.proposals:
+            return
+        self.proposals[p.blockhash] = p
+        self.by_parent.setdefault(p.block.prevhash, set()).add(p.blockhash)
+        if p.height not in self.by_height:
+            bisect.insort(self.heights, p.height)
+            self.by_height[p.height] = set()
+        self.by_height[p.height].add(p.blockhash)
+
+    def pop(self, blockhash):
+        p = self.proposals.pop(blockhash)
+        for index, key in ((self.by_parent, p.block.prevhash), (self.by_height, p.height)):
+            index[key].remove(blockhash)
+            if not index[key]:
+                del index[key]
+        if p.height not in self.by_height:
+            del self.heights[bisect.bisect_left(self.heights, p.height)]
+        return p
+
+    def children(self, blockhash):
+        "the candidates whose parent is blockhash"
+        return [self.proposals[h] for h in self.by_parent.get(blockhash, ())]
+
+    def prune(self, height):
+        "removes the candidates up to height"
+        while self.heights and self.heights[0] <= height:
+            for blockhash in list(self.by_height[self.heights[0]]):
+                self.pop(blockhash)
 
 
 class MissingParent(Exception):
@@ -85,6 +167,9 @@ class ConsensusManager(object):
     round_timeout = 3  # timeout when waiting for proposal
     round_timeout_factor = 1.5  # timeout increase per round
     transaction_timeout = 0.5  # delay when waiting for new transaction
+    max_future_heights = 1024  # votes received beyond the current height are dropped
+    max_future_rounds = 32  # votes received beyond the round of their height are dropped
+    process_coalescing_window = 0.  # secs events are collected before they are processed
 
     def __init__(self, chainservice, consensus_contract, privkey):
         self.chainservice = chainservice
@@ -94,9 +179,17 @@ class ConsensusManager(object):
 
         self.synchronizer = Synchronizer(self)
         self.heights = ManagerDict(HeightManager, self)
-        self.block_candidates = dict()  # blockhash : BlockProposal
+        self._highest_committing_lockset = None  # maintained by the HeightManagers
+        self.block_candidates = BlockCandidates()
 
         self.tracked_protocol_failures = list()
+        self.num_logged_failures = 0
+        self.process_scheduled = False
+        self.processing = False  # a pass is running, see process
+        self.process_again = False
+        self.committing = False
+        self.timeout_alarm = None
+        self.transaction_alarm = None
 
         # wait for enough validators in order to start
         self.ready_validators = set()  # addresses
@@ -150,7 +243,7 @@ class ConsensusManager(object):
 
     def store_proposal(self, p):
         assert isinstance(p, BlockProposal)
-        self.chainservice.db.put('blockproposal:%s' % p.blockhash, rlp.encode(p))
+        self.chainservice.db.put('blockproposal:%s' % p.blockhash, p.encode())
 
     def load_proposal_rlp(self, blockhash):
         try:
@@ -238,9 +331,23 @@ class ConsensusManager(object):
         else:
             self.send_ready()
 
+    def in_vote_window(self, v):
+        "if v is not too far ahead, so a flood of votes can't create unbounded managers"
+        if v.height > self.height + self.max_future_heights:
+            return False
+        hm = self.heights.get(v.height)
+        return v.round <= (hm.round if hm else 0) + self.max_future_rounds
+
     def add_vote(self, v, proto=None):
+        """
+        Votes received from peers are dropped, if they are beyond the window,
+        votes of valid locksets (e.g. of proposals) are always added.
+        """
         assert isinstance(v, Vote)
         assert self.contract.isvalidator(v.sender)
+        if proto is not None and not self.in_vote_window(v):
+            self.log('dropping vote beyond window', v=v, height=self.height)
+            return
         self.ready_validators.add(v.sender)
         # exception for externaly received votes signed by self, necessary for resyncing
         is_own_vote = bool(v.sender == self.coinbase)
@@ -263,6 +370,9 @@ class ConsensusManager(object):
                 raise InvalidProposalError()
             return True
 
+        # in parallel, before its votes are added one by one. may yield, so the checks
+        # below see the state after it
+        verify_senders(p)
         self.log('cm.add_proposal', p=p)
         if p.height < self.height:
             self.log('proposal from the past')
@@ -303,9 +413,7 @@ class ConsensusManager(object):
                     raise ForkDetectedEvidence(proto, (self.head, p, ls))
                     sys.exit(1)
                 return
-            p._mutable = True
-            p._cached_rlp = None
-            p.block = blk  # block linked to chain
+            p.set_linked_block(blk)
             self.log('successfully linked block')
             self.add_block_proposal(p)  # implicitly checks the votes validity
         else:
@@ -321,6 +429,7 @@ class ConsensusManager(object):
 
     def add_lockset(self, ls, proto=None):
         assert ls.is_valid
+        verify_senders(ls)
         for v in ls:
             self.add_vote(v)  # implicitly checks their validity
 
@@ -333,7 +442,7 @@ class ConsensusManager(object):
         assert p.signing_lockset.height == p.height - 1
         for v in p.signing_lockset:
             self.add_vote(v)
-        self.block_candidates[p.blockhash] = p
+        self.block_candidates.add(p)
 
     @property
     def last_committing_lockset(self):
@@ -341,10 +450,13 @@ class ConsensusManager(object):
 
     @property
     def highest_committing_lockset(self):
-        for height in self.heights:
-            ls = self.heights[height].last_quorum_lockset
-            if ls:
-                return ls
+        return self._highest_committing_lockset
+
+    def on_quorum_lockset(self, ls):
+        "called by a HeightManager which found a quorum on its height"
+        highest = self._highest_committing_lockset
+        if not highest or (ls.height, ls.round) >= (highest.height, highest.round):
+            self._highest_committing_lockset = ls
 
     @property
     def last_valid_lockset(self):
@@ -374,11 +486,16 @@ class ConsensusManager(object):
         self.log('in set up alarm', delay=delay)
         if self.is_waiting_for_proposal:
             if delay is not None:
-                self.chainservice.setup_alarm(delay, self.on_alarm, ar)
+                if self.timeout_alarm:  # of a previous round
+                    self.timeout_alarm.cancel()
+                self.timeout_alarm = self.chainservice.setup_alarm(delay, self.on_alarm, ar)
                 self.log('set up alarm on timeout', now=self.chainservice.now,
                          delay=delay, triggered=delay + self.chainservice.now)
-        else:
-            self.chainservice.setup_transaction_alarm(self.on_alarm, ar)
+        elif not self.transaction_alarm or self.transaction_alarm.cancelled or \
+                self.transaction_alarm.args != (ar,):  # one is enough
+            if self.transaction_alarm:
+                self.transaction_alarm.cancel()
+            self.transaction_alarm = self.chainservice.setup_transaction_alarm(self.on_alarm, ar)
             self.log('set up alarm on tx', now=self.chainservice.now)
 
     def on_alarm(self, ar):
@@ -406,9 +523,38 @@ class ConsensusManager(object):
     def has_pending_transactions(self):
         return self.chain.head_candidate.num_transactions() > 0
 
+    def schedule_process(self):
+        """
+        Message handlers add votes, proposals etc. and schedule a processing pass,
+        so a burst of them (e.g. the votes at the end of a round) is processed at once.
+        """
+        if self.process_scheduled:
+            return
+        self.process_scheduled = True
+        self.chainservice.setup_alarm(self.process_coalescing_window, self.on_process_alarm)
+
+    def on_process_alarm(self):
+        if self.process_scheduled:  # otherwise process ran meanwhile
+            self.process()
+
     def process(self):
-        r = self._process()
-        return r
+        """
+        Passes do not overlap: committing and proposing can wait for the chainservice's
+        add_transaction_lock, a call meanwhile lets the running pass process again.
+        """
+        if self.processing:
+            self.process_again = True
+            return
+        self.processing = True
+        try:
+            while True:
+                self.process_scheduled = False
+                self.process_again = False
+                r = self._process()
+                if not self.process_again:
+                    return r
+        finally:
+            self.processing = False
 
     def _process(self):
         self.log('-' * 40)
@@ -425,39 +571,52 @@ class ConsensusManager(object):
         self.synchronizer.process()
         self.setup_alarm()
 
-        for f in self.tracked_protocol_failures:
+        for f in self.tracked_protocol_failures[self.num_logged_failures:]:
             if not isinstance(f, FailedToProposeEvidence):
                 log.warn('protocol failure', incident=f)
+        self.num_logged_failures = len(self.tracked_protocol_failures)
 
     start = process
 
     def commit(self):
+        "commits all possible candidates, following their chain from the head"
         self.log('in commit')
-        for p in [c for c in self.block_candidates.values() if c.block.prevhash == self.head.hash]:
-            assert isinstance(p, BlockProposal)
-            ls = self.heights[p.height].last_quorum_lockset
-            if ls and ls.has_quorum == p.blockhash:
-                self.store_proposal(p)
-                self.store_last_committing_lockset(ls)
-                success = self.chainservice.commit_block(p.block)
-                assert success
-                if success:
-                    self.log('commited', p=p, hash=phx(p.blockhash))
-                    assert self.head == p.block
-                    self.commit()  # commit all possible
-                    return True
+        if self.committing:  # waiting in commit_block, continues with the new candidates
+            return False
+        self.committing = True
+        try:
+            return self._commit()
+        finally:
+            self.committing = False
+
+    def _commit(self):
+        committed = False
+        while True:
+            for p in self.block_candidates.children(self.head.hash):
+                assert isinstance(p, BlockProposal)
+                ls = self.heights[p.height].last_quorum_lockset
+                if ls and ls.has_quorum == p.blockhash:
+                    self.store_proposal(p)
+                    self.store_last_committing_lockset(ls)
+                    success = self.chainservice.commit_block(p.block)
+                    assert success
+                    if success:
+                        self.log('commited', p=p, hash=phx(p.blockhash))
+                        assert self.head == p.block
+                        committed = True
+                        break  # continue with the children of the new head
+                    else:
+                        self.log('could not commit', p=p)
                 else:
-                    self.log('could not commit', p=p)
+                    self.log('no quorum for', p=p)
+                    if ls:
+                        self.log('votes', votes=ls.votes)
             else:
-                self.log('no quorum for', p=p)
-                if ls:
-                    self.log('votes', votes=ls.votes)
+                return committed
 
     def cleanup(self):
         self.log('in cleanup')
-        for p in self.block_candidates.values():
-            if self.head.number >= p.height:
-                self.block_candidates.pop(p.blockhash)
+        self.block_candidates.prune(self.head.number)
         for h in list(self.heights):
             if self.heights[h].height < self.head.number:
                 self.heights.pop(h)
@@ -467,16 +626,28 @@ class ConsensusManager(object):
 
     def sign(self, o):
         assert isinstance(o, Signed)
-        return o.sign(self.privkey)
+        return self.chainservice.sign(o)
 
 
 class HeightManager(object):
 
+    """
+    The locksets, locks and proposals of the rounds on a height.
+
+    The highest valid lockset, quorum lockset, lock and voted proposal are maintained
+    as votes and proposals are added to the rounds (see update), so looking them up does
+    not scan the rounds.
+    """
+
     def __init__(self, consensusmanager, height=0):
         self.cm = consensusmanager
         self.log = self.cm.log
         self.height = height
         self.rounds = ManagerDict(RoundManager, self)
+        self._last_valid_lockset = None
+        self._last_quorum_lockset = None
+        self._last_lock = None
+        self._last_voted_blockproposal = None
         log.debug('A:%s Created HeightManager H:%d' % (phx(self.cm.coinbase), self.height))
 
     @property
@@ -489,46 +660,24 @@ class HeightManager(object):
     @property
     def last_lock(self):
         "highest lock on height"
-        rs = list(self.rounds)
-        assert len(rs) < 2 or rs[0] > rs[1]  # FIXME REMOVE
-        for r in self.rounds:  # is sorted highest to lowest
-            if self.rounds[r].lock is not None:
-                return self.rounds[r].lock
+        return self._last_lock
 
     @property
     def last_voted_blockproposal(self):
         "the last block proposal node voted on"
-        for r in self.rounds:
-            if isinstance(self.rounds[r].proposal, BlockProposal):
-                assert isinstance(self.rounds[r].lock, Vote)
-                if self.rounds[r].proposal.blockhash == self.rounds[r].lock.blockhash:
-                    return self.rounds[r].proposal
+        p = self._last_voted_blockproposal
+        if p:
+            assert isinstance(self.rounds[p.round].lock, Vote)
+        return p
 
     @property
     def last_valid_lockset(self):
         "highest valid lockset on height"
-        for r in self.rounds:
-            ls = self.rounds[r].lockset
-            if ls.is_valid:
-                return ls
-        return None
+        return self._last_valid_lockset
 
     @property
     def last_quorum_lockset(self):
-        found = None
-        for r in sorted(self.rounds):  # search from lowest round first
-            ls = self.rounds[r].lockset
-            if ls.is_valid and ls.has_quorum:
-                if found is not None:  # consistency check, only one quorum on block allowed
-                    for r in sorted(self.rounds):  # dump all locksets
-                        self.log('multiple valid locksets', round=r, ls=self.rounds[r].lockset,
-                                 votes=self.rounds[r].lockset.votes)
-                    if found.has_quorum != ls.has_quorum:
-                        log.error('FATAL: multiple valid locksets on different proposals')
-                        import sys
-                        sys.exit(1)
-                found = ls
-        return found
+        return self._last_quorum_lockset
 
     @property
     def has_quorum(self):
@@ -536,6 +685,40 @@ class HeightManager(object):
         if ls:
             return ls.has_quorum
 
+    def update(self, rm):
+        "updates the cached state after a vote, lock or proposal was added to round rm"
+        if rm.lock is not None:
+            if self._last_lock is None or rm.round >= self._last_lock.round:
+                self._last_lock = rm.lock
+        if isinstance(rm.proposal, BlockProposal) and isinstance(rm.lock, Vote) and \
+                rm.proposal.blockhash == rm.lock.blockhash:
+            p = self._last_voted_blockproposal
+            if p is None or rm.round >= p.round:
+                self._last_voted_blockproposal = rm.proposal
+        ls = rm.lockset
+        if not ls.is_valid:
+            return
+        if self._last_valid_lockset is None or ls.round >= self._last_valid_lockset.round:
+            self._last_valid_lockset = ls
+        if ls.has_quorum:
+            self.add_quorum_lockset(ls)
+
+    def add_quorum_lockset(self, ls):
+        found = self._last_quorum_lockset
+        if found is not None and found is not ls:
+            # consistency check, only one quorum on block allowed
+            for r in sorted(self.rounds):  # dump all locksets
+                self.log('multiple valid locksets', round=r, ls=self.rounds[r].lockset,
+                         votes=self.rounds[r].lockset.votes)
+            if found.has_quorum != ls.has_quorum:
+                log.error('FATAL: multiple valid locksets on different proposals')
+                import sys
+                sys.exit(1)
+            if found.round > ls.round:
+                return
+        self._last_quorum_lockset = ls
+        self.cm.on_quorum_lockset(ls)
+
     def add_vote(self, v, force_replace=False):
         return self.rounds[v.round].add_vote(v, force_replace)
 
@@ -589,6 +772,7 @@ class RoundManager(object):
         except InvalidVoteError:
             self.cm.tracked_protocol_failures.append(InvalidVoteEvidence(None, v))
             return
+        self.hm.update(self)
         # report failed proposer
         if self.lockset.is_valid:
             self.log('lockset is valid', ls=self.lockset)
@@ -603,6 +787,7 @@ class RoundManager(object):
         assert isinstance(p, VotingInstruction) or isinstance(p.block, Block)  # already linked
         assert not self.proposal or self.proposal == p
         self.proposal = p
+        self.hm.update(self)
         return True
 
     def process(self):
@@ -630,10 +815,15 @@ class RoundManager(object):
         assert signing_lockset.has_quorum
         # for R0 (std case) we only need one lockset!
         assert round_lockset is None or self.round > 0
+        self.cm.chainservice.apply_pending_transactions()  # draw the ready txs from the pool
+        if (self.cm.height, self.cm.round) != (self.height, self.round):
+            self.log('moved on while applying txs, not proposing')
+            return
         block = self.cm.chain.head_candidate
         # fix pow
         block.header.__class__ = HDCBlockHeader
         block.should_be_locked = True
+        block.is_executed = True  # the txs were applied to it, no need to verify on commit
         bp = BlockProposal(self.height, self.round, block, signing_lockset, round_lockset)
         self.cm.sign(bp)
         self.cm.set_proposal_lock(block)
@@ -665,6 +855,8 @@ class RoundManager(object):
             return
         elif self.round == 0 or round_lockset.has_noquorum:
             proposal = self.mk_proposal()
+            if not proposal:
+                return
         elif round_lockset.has_quorum_possible:
             proposal = VotingInstruction(self.height, self.round, round_lockset.copy())
             self.cm.sign(proposal)
@@ -673,6 +865,7 @@ class RoundManager(object):
 
         self.log('created proposal', p=proposal, bh=phx(proposal.blockhash))
         self.proposal = proposal
+        self.hm.update(self)
         return proposal
 
     def vote(self):
@@ -711,6 +904,7 @@ class RoundManager(object):
 
         self.log('voted', vote=v)
         self.lock = v
-        assert self.hm.last_lock == self.lock
         self.lockset.add(v)
+        self.hm.update(self)
+        assert self.hm.last_lock == self.lock
         return v
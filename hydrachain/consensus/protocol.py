@@ -1,8 +1,13 @@
 import rlp
 import gevent
-from devp2p.protocol import BaseProtocol, SubProtocolError
+from devp2p.peer import Peer
+from devp2p.peermanager import PeerManager
+from devp2p.protocol import BaseProtocol, SubProtocolError, ProtocolError
 from ethereum.transactions import Transaction
 from hydrachain.consensus.base import BlockProposal, VotingInstruction, Vote, LockSet, Ready
+from hydrachain.consensus.base import CompactBlockProposal
+from hydrachain.consensus.utils import DuplicatesFilter
+from hydrachain.utils import sha3
 from ethereum import slogging
 log = slogging.get_logger('protocol.hdc')
 
@@ -11,6 +16,47 @@ class HDCProtocolError(SubProtocolError):
     pass
 
 
+class MessagePayload(list):
+
+    "command data of a consensus message and the format to encode it in"
+
+    compact = False  # LockSets in the CompactLockSet format
+
+
+class message_command(BaseProtocol.command):
+
+    """
+    Base for commands carrying a single consensus message.
+
+    LockSets are sent in the CompactLockSet format to peers supporting it, decoding
+    accepts both formats. The encoded payload is kept on the message, so a broadcast
+    encodes it once per format and received payloads are relayed as they are.
+    """
+
+    def create(self, proto, *args, **kargs):
+        data = super(message_command, self).create(proto, *args, **kargs)
+        if isinstance(data, dict):
+            data = [data[name] for name, _ in self.structure]
+        payload = MessagePayload(data)
+        payload.compact = proto.peer_version >= proto.compact_lockset_version
+        return payload
+
+    @classmethod
+    def encode_payload(cls, data):
+        if not isinstance(data, MessagePayload):
+            return super(message_command, cls).encode_payload(data)
+        obj, = data
+        if obj._payloads is None:
+            obj._payloads = dict()
+        if data.compact not in obj._payloads:
+            if data.compact:
+                sedes = rlp.sedes.List([sedes.compact_sedes() for _, sedes in cls.structure])
+            else:
+                sedes = rlp.sedes.List([sedes for _, sedes in cls.structure])
+            obj._payloads[data.compact] = rlp.encode(list(data), sedes=sedes)
+        return obj._payloads[data.compact]
+
+
 class HDCProtocol(BaseProtocol):
 
     """
@@ -20,14 +66,65 @@ class HDCProtocol(BaseProtocol):
     network_id = 0
     max_cmd_id = 15  # FIXME
     name = 'hdc'
-    version = 1
+    version = 1  # the capability devp2p matches, the features are negotiated by HDCPeer
+    max_version = 4
+    min_version = 1  # oldest version we can talk to
+    compact_lockset_version = 2
+    votes_version = 3
+    compact_proposal_version = 4
+    peer_version = min_version  # the negotiated version
     max_getproposals_count = 10
+    max_known_transactions = 8192
+    # consensus messages which are filtered by their payload before decoding
+    message_commands = ('newblockproposal', 'votinginstruction', 'vote', 'ready',
+                        'compactproposal')
+    payload_filter = None  # DuplicatesFilter shared by the service
 
     def __init__(self, peer, service):
         # required by P2PProtocol
         self.config = peer.config
+        # hashes of messages the peer sent us, or we sent to it
+        self.known_messages = DuplicatesFilter()
+        self.known_transactions = DuplicatesFilter(self.max_known_transactions)
+        self.peer_version = getattr(peer, 'hdc_version', self.min_version)
         BaseProtocol.__init__(self, peer, service)
 
+    @classmethod
+    def versions(cls):
+        "the supported versions, the highest first"
+        return range(cls.max_version, cls.min_version - 1, -1)
+
+    @classmethod
+    def negotiate_version(cls, capabilities):
+        "the highest version announced in the capabilities of a peer which we support"
+        versions = [v for name, v in capabilities if name == cls.name and v in cls.versions()]
+        return max(versions or [cls.min_version])
+
+    def receive_packet(self, packet):
+        """
+        Consensus messages whose payload was seen before (see payload_filter) are dropped
+        without decoding them. Otherwise the payload and its hash are kept on the message.
+        """
+        cmd_name = self.cmd_by_id[packet.cmd_id]
+        if cmd_name not in self.message_commands:
+            return super(HDCProtocol, self).receive_packet(packet)
+        payload_hash = sha3(packet.payload)
+        if self.payload_filter is not None and payload_hash in self.payload_filter:
+            log.debug('dropping known payload', cmd=cmd_name, proto=self)
+            return
+        klass = getattr(self, cmd_name)
+        try:
+            data = klass.decode_payload(packet.payload)
+            obj = data[klass.structure[0][0]]
+            obj._payload_hash = payload_hash
+            # the peer sent it in the format it expects from us, keep it for relaying
+            obj._payloads = {self.peer_version >= self.compact_lockset_version: packet.payload}
+            for cb in getattr(self, 'receive_%s_callbacks' % cmd_name):
+                cb(self, **data)
+        except ProtocolError as e:
+            log.warn('protocol exception, stopping', error=e)
+            self.stop()
+
     class status(BaseProtocol.command):
 
         """
@@ -63,7 +160,7 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 1
         structure = rlp.sedes.CountableList(Transaction)
 
-        # todo: bloomfilter: so we don't send tx to the originating peer
+        # txs sent by or to the peer are tracked in HDCProtocol.known_transactions
 
         @classmethod
         def decode_payload(cls, rlp_data):
@@ -102,7 +199,7 @@ class HDCProtocol(BaseProtocol):
             assert not list_of_rlp or isinstance(list_of_rlp[0], bytes)
             return rlp.encode([rlp.codec.RLPData(x) for x in list_of_rlp], infer_serializer=False)
 
-    class newblockproposal(BaseProtocol.command):
+    class newblockproposal(message_command):
 
         """
         Specify a single BlockProposal that the peer should know about.
@@ -110,7 +207,7 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 4
         structure = [('proposal', BlockProposal)]
 
-    class votinginstruction(BaseProtocol.command):
+    class votinginstruction(message_command):
 
         """
         Specify a single VotingInstruction that the peer should know about.
@@ -118,7 +215,7 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 5
         structure = [('votinginstruction', VotingInstruction)]
 
-    class vote(BaseProtocol.command):
+    class vote(message_command):
 
         """
         Specify a single Vote that the peer should know about.
@@ -126,6 +223,90 @@ class HDCProtocol(BaseProtocol):
         cmd_id = 6
         structure = [('vote', Vote)]
 
-    class ready(BaseProtocol.command):
+    class votes(BaseProtocol.command):
+
+        """
+        Specify a list of Votes that the peer should know about (since version 3).
+        """
+        cmd_id = 8
+        structure = rlp.sedes.CountableList(Vote)
+
+    class ready(message_command):
         cmd_id = 7
         structure = [('ready', Ready)]
+
+    class compactproposal(message_command):
+
+        """
+        Specify a single BlockProposal whose transactions are referenced by hash
+        (since version 4). Transactions the peer lacks are requested with getblocktransactions.
+        """
+        cmd_id = 9
+        structure = [('proposal', CompactBlockProposal)]
+
+    class getblocktransactions(BaseProtocol.command):
+
+        """
+        Requests the transactions of a CompactBlockProposal which are not in the pool.
+        """
+        cmd_id = 10
+        structure = [
+            ('blockhash', rlp.sedes.binary),
+            ('transaction_hashes', rlp.sedes.CountableList(rlp.sedes.binary))
+        ]
+
+    class blocktransactions(BaseProtocol.command):
+
+        """
+        Transactions sent in response to a getblocktransactions request
+        """
+        cmd_id = 11
+        structure = [
+            ('blockhash', rlp.sedes.binary),
+            ('transactions', rlp.sedes.CountableList(Transaction))
+        ]
+
+
+class HDCPeer(Peer):
+
+    """
+    Peer which negotiates the HDCProtocol version in the hello.
+
+    devp2p only starts a subprotocol if the remote announces the local version of it,
+    keeping the last announced version per protocol name. So all supported versions
+    are announced, the highest first and HDCProtocol.version last: nodes of version 1
+    connect as before, while two HDCPeers use the highest version both support.
+    """
+
+    hdc_version = HDCProtocol.min_version
+
+    @property
+    def capabilities(self):
+        capabilities = []
+        for name, version in super(HDCPeer, self).capabilities:
+            if name == HDCProtocol.name:
+                capabilities.extend((name, v) for v in HDCProtocol.versions())
+            else:
+                capabilities.append((name, version))
+        return capabilities
+
+    def receive_hello(self, proto, version, client_version_string, capabilities,
+                      listen_port, remote_pubkey):
+        self.hdc_version = HDCProtocol.negotiate_version(capabilities)
+        log.debug('negotiated version', version=self.hdc_version, peer=self)
+        super(HDCPeer, self).receive_hello(proto, version, client_version_string,
+                                           capabilities, listen_port, remote_pubkey)
+
+
+class HDCPeerManager(PeerManager):
+
+    "PeerManager whose peers are HDCPeers"
+
+    def _start_peer(self, connection, address, remote_pubkey=None):
+        peer = HDCPeer(self, connection, remote_pubkey=remote_pubkey)
+        log.debug('created new peer', peer=peer, fno=connection.fileno())
+        self.peers.append(peer)
+        peer.start()
+        log.debug('peer started', peer=peer, fno=connection.fileno())
+        assert not connection.closed
+        return peer
@@ -116,6 +116,7 @@ class PeerMock(object):
     base_latency = 0.05  # secs
     ingress_bytes = 0
     egress_bytes = 0
+    hdc_version = hdc_protocol.HDCProtocol.max_version  # as negotiated by HDCPeers
 
     def __init__(self, app, transport):
         self.app = app
@@ -190,13 +191,15 @@ class SimChainService(ChainService):
         assert self.simenv
         return self.simenv.now
 
-    def setup_alarm(self, delay, cb, *args):
+    def start_timer(self, delay, cb):
         assert self.simenv
+        timer = self.simenv.timeout(delay)
+        timer.stopped = False
+        timer.callbacks.append(lambda timer: timer.stopped or cb())
+        return timer
 
-        def _trigger():
-            yield self.simenv.timeout(delay)
-            cb(*args)
-        self.simenv.process(_trigger())
+    def stop_timer(self, timer):
+        timer.stopped = True
 
     def on_receive_newblockproposal(self, proto, proposal):
 
@@ -229,6 +232,7 @@ class AppMock(object):
         account = Account.new(password='', key=privkey)
         self.services.accounts.add_account(account, store=False)
         if simenv:
+            self.config['hdc']['execute_in_worker'] = False  # simulated time would not pass
             self.services.chainservice = SimChainService(self, simenv=simenv)
         else:
             self.services.chainservice = hdc_service.ChainService(self)
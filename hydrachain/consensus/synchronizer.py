@@ -1,5 +1,5 @@
 import gevent
-from .base import Proposal
+from .base import Proposal, verify_senders
 from .protocol import HDCProtocol
 
 
@@ -90,6 +90,7 @@ class Synchronizer(object):
 
     def receive_blockproposals(self, proposals):
         self.cm.log('receive_blockproposals', p=proposals, received=self.received)
+        verify_senders(proposals)
         for p in proposals:
             self.received.add(p.height)
             self.requested.remove(p.height)
@@ -97,16 +98,17 @@ class Synchronizer(object):
                 self.cm.add_vote(v)
 
         # commit after we added new votes to commit a block from the last sync
-        self.cm.process()
+        self.cm.commit()
 
         # request next round
         self.request()
         self.add_proposals_lock.acquire()
         for p in proposals:
             self.cm.add_proposal(p)
-            self.cm.process()
+            self.cm.commit()  # so the next proposal is linked on top of it
         self.cleanup()
         self.add_proposals_lock.release()
+        self.cm.schedule_process()  # once for the whole batch
 
         not_added = []
         for p in proposals:
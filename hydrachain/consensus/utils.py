@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from sha3 import sha3_256
 from ethereum.utils import big_endian_to_int
 
@@ -34,6 +35,52 @@ def cprint(num, txt):
 def phx(x):
     return x.encode('hex')[:8]
 
+
+class DuplicatesFilter(object):
+
+    """
+    Remembers the last max_items keys (e.g. message hashes), keys seen again are
+    refreshed. Membership, refresh and eviction are O(1).
+    Optionally a value (e.g. the message) is kept with the key.
+    """
+
+    def __init__(self, max_items=1024):
+        self.max_items = max_items
+        self.filter = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, data, value=True):
+        "returns True if unknown"
+        if data not in self.filter:
+            self.filter[data] = value
+            if len(self.filter) > self.max_items:
+                self.filter.popitem(last=False)
+            self.misses += 1
+            return True
+        else:
+            del self.filter[data]
+            self.filter[data] = value  # most recently seen last
+            self.hits += 1
+            return False
+
+    def __contains__(self, v):
+        return v in self.filter
+
+    def __getitem__(self, k):
+        return self.filter[k]
+
+    def __len__(self):
+        return len(self.filter)
+
+    @property
+    def hit_rate(self):
+        return self.hits / float(self.hits + self.misses or 1)
+
+    def __repr__(self):
+        return '<DuplicatesFilter(size=%d hits=%d misses=%d)>' % (
+            len(self), self.hits, self.misses)
+
 if __name__ == '__main__':
     for i in range(len(colors)):
         cprint(i, 'test')
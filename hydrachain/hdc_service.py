@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import time
 from ethereum.config import Env
 from ethereum.utils import sha3
@@ -8,60 +10,103 @@ from ethereum.slogging import get_logger
 from ethereum.chain import Chain
 from ethereum.refcount_db import RefcountDB
 from ethereum.blocks import Block, VerificationFailed
+from ethereum.exceptions import InvalidTransaction
 from ethereum.transactions import Transaction
 from devp2p.service import WiredService
 from ethereum import config as ethereum_config
 import gevent
+import gevent.event
 import gevent.lock
+import gevent.threadpool
 from collections import deque
 from gevent.queue import Queue
 from pyethapp.eth_service import ChainService as eth_ChainService
 from .consensus.protocol import HDCProtocol, HDCProtocolError
 from .consensus.base import (Signed, VotingInstruction, BlockProposal, VoteBlock, VoteNil,
-                             HDCBlockHeader, LockSet, Ready)
-from .consensus.utils import phx
+                             HDCBlockHeader, LockSet, Ready, contexts, signed_messages,
+                             verify_senders, CompactBlockProposal, InvalidProposalError,
+                             InvalidSignature)
+from .consensus.utils import phx, DuplicatesFilter
 from .consensus.manager import ConsensusManager
 from .consensus.contract import ConsensusContract
+from .txpool import TransactionPool, validate_transaction
 
 
 log = get_logger('hdc.chainservice')
 
 
+class ApplyScheduler(object):
+
+    """
+    Applying the txs of a block does not switch greenlets, so while a big block is
+    executed votes and timeouts stall. If an interval (secs) is set, the hub gets a turn
+    once the txs were executed that long, instead of before every tx.
+    Per block the longest time the hub was blocked is measured.
+    Only txs applied between start and stop are scheduled, not those on worker threads.
+    """
+
+    def __init__(self, interval=0):
+        self.interval = interval  # 0: never yield
+        self.start()
+        self.active = False
+
+    def start(self):
+        self.active = True
+        self.last = time.time()
+        self.max_blocked = 0.
+        self.num_yields = 0
+
+    def checkpoint(self):
+        if not self.active:
+            return
+        blocked = time.time() - self.last
+        if self.interval and blocked >= self.interval:
+            self.max_blocked = max(self.max_blocked, blocked)
+            self.num_yields += 1
+            gevent.sleep(0)
+            self.last = time.time()
+
+    def stop(self):
+        "returns the longest time the hub was blocked since start"
+        self.active = False
+        self.max_blocked = max(self.max_blocked, time.time() - self.last)
+        return self.max_blocked
+
+
+apply_scheduler = ApplyScheduler()  # the hub is shared by all chainservices of the process
+
 # patch to get context switches between tx replay
 processblock_apply_transaction = processblock.apply_transaction
 
 
 def apply_transaction(block, tx):
-    # import traceback
-    # print traceback.print_stack()
-    log.debug('apply_transaction ctx switch', tx=tx.hash.encode('hex')[:8])
-    gevent.sleep(0.0000001)
+    apply_scheduler.checkpoint()
     return processblock_apply_transaction(block, tx)
-# processblock.apply_transaction = apply_transaction
 
 
-rlp_hash_hex = lambda data: encode_hex(sha3(rlp.encode(data)))
+processblock.apply_transaction = apply_transaction
 
+# patch so blocks which were executed already are not decoded and rebuilt in Chain.add_block
+processblock_verify = processblock.verify
 
-class DuplicatesFilter(object):
 
-    def __init__(self, max_items=1024):
-        self.max_items = max_items
-        self.filter = list()
+def verify(block, parent):
+    """
+    blocks marked as is_executed were executed on top of their parent by us.
+    The mark is used once, a block verified again is decoded and rebuilt.
+    """
+    if getattr(block, 'is_executed', False):
+        del block.is_executed
+        if block.prevhash != parent.hash:
+            raise VerificationFailed('executed on another parent', block, parent)
+        return True
+    return processblock_verify(block, parent)
 
-    def update(self, data):
-        "returns True if unknown"
-        if data not in self.filter:
-            self.filter.append(data)
-            if len(self.filter) > self.max_items:
-                self.filter.pop(0)
-            return True
-        else:
-            self.filter.append(self.filter.pop(0))
-            return False
 
-    def __contains__(self, v):
-        return v in self.filter
+processblock.verify = verify
+
+
+rlp_hash_hex = lambda data: encode_hex(sha3(rlp.encode(data)))
 
 
 def update_watcher(chainservice):
@@ -114,6 +159,81 @@ class ProposalLock(gevent.lock.BoundedSemaphore):
     __str__ = __repr__
 
 
+class Alarm(object):
+
+    "handle of an alarm, cancelled alarms are not called"
+
+    def __init__(self, deadline, cb, args, on_cancel=None):
+        self.deadline = deadline
+        self.cb = cb
+        self.args = args
+        self.on_cancel = on_cancel  # called once, when the alarm is cancelled or fired
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Alarm(%r deadline=%s cancelled=%s)>' % (self.cb, self.deadline, self.cancelled)
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            if self.on_cancel:
+                self.on_cancel()
+
+    def fire(self):
+        if not self.cancelled:
+            self.cancel()  # called once
+            self.cb(*self.args)
+
+
+class Alarms(object):
+
+    """
+    Pending alarms in a heap. Only one timer is started, for the earliest alarm,
+    instead of a greenlet per alarm. Cancelled alarms are skipped.
+
+    clock provides `now`, `start_timer(delay, cb)` and `stop_timer(timer)`,
+    i.e. the ChainService under gevent or simpy.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []  # (deadline, counter, alarm)
+        self._counter = itertools.count()
+        self.timer = None
+        self.timer_deadline = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, delay, cb, *args):
+        alarm = Alarm(self.clock.now + delay, cb, args)
+        heapq.heappush(self.heap, (alarm.deadline, next(self._counter), alarm))
+        self._start_timer()
+        return alarm
+
+    def _start_timer(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.clock.stop_timer(self.timer)
+        self.timer_deadline = deadline
+        self.timer = self.clock.start_timer(max(0, deadline - self.clock.now), self.on_timer)
+
+    def on_timer(self):
+        "calls the due alarms"
+        self.timer = None
+        try:
+            while self.heap and self.heap[0][0] <= self.clock.now:
+                heapq.heappop(self.heap)[2].fire()
+        finally:
+            self._start_timer()
+
+
 class ChainService(eth_ChainService):
 
     """
@@ -125,7 +245,10 @@ class ChainService(eth_ChainService):
                                    genesis='',
                                    pruning=-1,
                                    block=ethereum_config.default_config),
-                          hdc=dict(validators=[]),
+                          hdc=dict(validators=[],
+                                   broadcast_filter_size=0,  # 0: derive from validators
+                                   apply_yield_interval=0.02,  # secs, 0: don't yield
+                                   execute_in_worker=True),  # execute proposed blocks off the hub
                           )
 
     # required by WiredService
@@ -141,6 +264,14 @@ class ChainService(eth_ChainService):
     processed_gas = 0
     processed_elapsed = 0
     min_block_time = 1.  # time we try to wait for more transactions after the first
+    broadcast_filter_rounds = 64  # rounds of consensus messages the broadcast filter remembers
+    vote_coalescing_window = 0.005  # secs votes are buffered to be sent in one packet
+    tx_flush_interval = 0.05  # secs txs are buffered per peer
+    tx_flush_size = 512  # num txs which are sent without waiting for the interval
+    recent_transactions_size = 16384  # txs kept by hash to rebuild compact proposals
+    max_pending_proposals = 32  # compact proposals waiting for txs
+    max_pending_proposals_per_peer = 4
+    block_executor = None  # thread pool executing proposed blocks, created on first use
 
     def __init__(self, app):
         self.config = app.config
@@ -186,15 +317,29 @@ class ChainService(eth_ChainService):
                     self.chain.genesis.hex_hash(), sce['genesis_hash'])
 
         self.transaction_queue = Queue(maxsize=self.transaction_queue_size)
+        self.alarms = Alarms(self)
         self.add_blocks_lock = False
         self.add_transaction_lock = gevent.lock.BoundedSemaphore()
-        self.broadcast_filter = DuplicatesFilter()
         self.on_new_head_cbs = []
         self.on_new_head_candidate_cbs = []
         self.newblock_processing_times = deque(maxlen=1000)
+        self.hub_blocked_times = deque(maxlen=1000)  # per applied block
+        apply_scheduler.interval = self.config['hdc'].get('apply_yield_interval', 0)
+        self.private_keys = dict()  # privkey: secp256k1.PrivateKey
 
         # Consensus
         validators = validators_from_config(self.config['hdc']['validators'])
+        self.broadcast_filter = DuplicatesFilter(self.broadcast_filter_size(len(validators)))
+        # hashes of the payloads of valid messages, known payloads are not decoded again
+        self.payload_filter = DuplicatesFilter(self.broadcast_filter.max_items)
+        self.peer_protocols = set()
+        self.vote_buffer = []  # (vote, exclude_peers) waiting to be sent
+        self.tx_buffers = dict()  # proto: [tx, ...] waiting to be sent
+        self.tx_flush_pending = False
+        self.recent_transactions = DuplicatesFilter(self.recent_transactions_size)  # hash: tx
+        self.pending_proposals = dict()  # blockhash: (proto, CompactBlockProposal) waiting for txs
+        self.linking = dict()  # blockhash: AsyncResult of the link_block in flight
+        self.transaction_pool = TransactionPool()
         self.consensus_contract = ConsensusContract(validators=validators)
         self.consensus_manager = ConsensusManager(self, self.consensus_contract,
                                                   self.consensus_privkey)
@@ -224,58 +369,113 @@ class ChainService(eth_ChainService):
 
     def sign(self, obj):
         assert isinstance(obj, Signed)
-        obj.sign(self.consensus_privkey)
+        privkey = self.consensus_privkey
+        if privkey not in self.private_keys:
+            self.private_keys[privkey] = contexts.private_key(privkey)
+        obj.sign(self.private_keys[privkey])
+        return obj
 
     @property
     def now(self):
         return time.time()
 
-    def setup_alarm(self, delay, cb, *args):
-        log.debug('setting up alarm')
+    def start_timer(self, delay, cb):
+        "calls cb in a greenlet after delay, returns the timer"
+        loop = gevent.get_hub().loop
+        loop.update()  # the cached loop time may lag behind now
+        timer = loop.timer(delay)
+        timer.start(gevent.spawn, cb)
+        return timer
 
-        def _trigger():
-            gevent.sleep(delay)
-            log.debug('alarm triggered')
-            cb(*args)
+    def stop_timer(self, timer):
+        timer.stop()
 
-        gevent.spawn(_trigger)
+    def setup_alarm(self, delay, cb, *args):
+        "calls cb(*args) after delay, returns the Alarm which can be cancelled"
+        log.debug('setting up alarm')
+        return self.alarms.add(delay, cb, *args)
 
     def setup_transaction_alarm(self, cb, *args):
+        "calls cb(*args) min_block_time after the next tx was added to the head_candidate"
         log.debug('setting up tx alarm')
 
-        class Trigger(object):
-
-            def __call__(me, blk):
-                self.on_new_head_candidate_cbs.remove(me)
-                log.debug('transaction alarm triggered')
+        def remove_trigger():
+            if trigger in self.on_new_head_candidate_cbs:
+                self.on_new_head_candidate_cbs.remove(trigger)
 
-                def do_trigger_delayed():
-                    gevent.sleep(seconds=self.min_block_time)
-                    log.debug('transaction alarm calling cbs')
-                    cb(*args)
-                gevent.spawn(do_trigger_delayed)
+        def trigger(blk):
+            remove_trigger()
+            log.debug('transaction alarm triggered', alarm=alarm)
+            self.setup_alarm(self.min_block_time, alarm.fire)
 
-        self.on_new_head_candidate_cbs.append(Trigger())
+        alarm = Alarm(None, cb, args, on_cancel=remove_trigger)
+        self.on_new_head_candidate_cbs.append(trigger)
+        return alarm
 
     def commit_block(self, blk):
         assert isinstance(blk.header, HDCBlockHeader)
         log.debug('trying to acquire transaction lock')
         self.add_transaction_lock.acquire()
-        success = self.chain.add_block(blk, forward_pending_transactions=True)
+        success = self.apply_cooperatively(
+            'commit', self.chain.add_block, blk, forward_pending_transactions=True)
         self.add_transaction_lock.release()
         log.debug('transaction lock release')
         log.info('new head', head=self.chain.head)
         return success
 
+    def apply_cooperatively(self, name, f, *args, **kargs):
+        "calls f which applies txs, yielding to the hub as configured"
+        apply_scheduler.start()
+        try:
+            return f(*args, **kargs)
+        finally:
+            blocked = apply_scheduler.stop()
+            self.hub_blocked_times.append(blocked)
+            log.debug('hub blocked', during=name, max_blocked='%.4fs' % blocked,
+                      yields=apply_scheduler.num_yields)
+
+    def execute_block(self, t_block):
+        """
+        Deserializes t_block, i.e. executes its txs. If hdc.execute_in_worker is set, this
+        runs on a worker thread and only blocks the calling greenlet, so votes, ready
+        messages and timeouts are handled meanwhile.
+        """
+        if not self.config['hdc'].get('execute_in_worker'):
+            return self.apply_cooperatively('link', t_block.to_block, env=self.chain.env)
+        if self.block_executor is None:
+            self.block_executor = gevent.threadpool.ThreadPool(1)
+        return self.block_executor.apply(t_block.to_block, kwds=dict(env=self.chain.env))
+
     def link_block(self, t_block):
+        """
+        Executes t_block on top of the head. The add_transaction_lock is held meanwhile,
+        so the head does not change while the block is executed on the worker.
+        The same block relayed by other peers meanwhile waits for and reuses the result.
+        """
         assert isinstance(t_block.header, HDCBlockHeader)
-        self.add_transaction_lock.acquire()
-        block = self._link_block(t_block)
-        if not block:
-            return
-        assert block.get_parent() == self.chain.head, (block.get_parent(), self.chain.head)
-        assert block.header.coinbase == t_block.header.coinbase
-        self.add_transaction_lock.release()
+        blockhash = t_block.header.hash
+        if blockhash in self.linking:
+            log.debug('block is being linked, waiting', block=t_block)
+            return self.linking[blockhash].get()
+        result = self.linking[blockhash] = gevent.event.AsyncResult()
+        try:
+            self.add_transaction_lock.acquire()
+            try:
+                block = self._link_block(t_block)
+            finally:
+                self.add_transaction_lock.release()
+            if block:
+                assert block.get_parent() == self.chain.head, \
+                    (block.get_parent(), self.chain.head)
+                assert block.header.coinbase == t_block.header.coinbase
+            else:
+                block = None
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self.linking[blockhash]
+        result.set(block)
         return block
 
     def _link_block(self, t_block):
@@ -291,12 +491,13 @@ class ChainService(eth_ChainService):
             return True  # already deserialized
         try:  # deserialize
             st = time.time()
-            block = t_block.to_block(env=self.chain.env)
+            block = self.execute_block(t_block)
+            block.is_executed = True  # keep state, receipts: commit_block won't replay it
             elapsed = time.time() - st
             log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
                       gas_used=block.gas_used, gpsec=self.gpsec(block.gas_used, elapsed))
             assert block.header.check_pow()
-        except processblock.InvalidTransaction as e:
+        except InvalidTransaction as e:
             log.warn('invalid transaction', block=t_block, error=e, FIXME='ban node')
             return
         except VerificationFailed as e:
@@ -306,27 +507,113 @@ class ChainService(eth_ChainService):
 
     def add_transaction(self, tx, origin=None, force_broadcast=False):
         """
-        Warning:
-        Locking proposal_lock may block incoming events which are necessary to unlock!
-        I.e. votes / blocks!
-        Take care!
+        Adds tx to the transaction_pool, ready txs are applied to the head_candidate.
+        While a proposal is in flight they stay in the pool, so this never waits for
+        the proposal_lock. Returns True if tx was added, False if it was rejected.
+        """
+        if self.is_syncing:
+            return bool(super(ChainService, self).add_transaction(tx, origin, force_broadcast))
+        success = self._add_to_pool(tx, origin)
+        if success:
+            self.apply_pending_transactions()
+        return success
+
+    def add_transactions(self, transactions, origin=None):
         """
+        Adds a batch of txs, their senders are recovered at once and the ready txs are
+        applied in one go. Returns the result of add_transaction per tx.
+        """
+        if self.is_syncing:
+            return [self.add_transaction(tx, origin) for tx in transactions]
+        verify_senders(transactions)  # the whole batch, on the worker threads
+        valid = [tx for tx in transactions if tx._sender]
+        if len(valid) < len(transactions):
+            log.debug('dropping txs with invalid signatures',
+                      num=len(transactions) - len(valid), remote_id=origin)
+        results = dict()
+        for tx in sorted(valid, key=lambda tx: (tx.sender, tx.nonce)):
+            if tx.hash not in results:  # duplicates are added once
+                results[tx.hash] = self._add_to_pool(tx, origin)
+        if any(results.values()):
+            self.apply_pending_transactions()
+        return [results.get(tx.hash, False) for tx in transactions]
+
+    def _add_to_pool(self, tx, origin):
+        "validates, pools and broadcasts tx, returns True if it was added, else False"
+        assert isinstance(tx, Transaction)
         self.consensus_manager.log(
             'add_transaction', blk=self.chain.head_candidate, lock=self.proposal_lock)
-        log.debug('add_transaction', lock=self.proposal_lock)
-        block = self.proposal_lock.block
-        self.proposal_lock.acquire()
-        self.consensus_manager.log('add_transaction acquired lock', lock=self.proposal_lock)
-        assert not hasattr(self.chain.head_candidate, 'should_be_locked')
-        success = super(ChainService, self).add_transaction(tx, origin, force_broadcast)
-        if self.proposal_lock.is_locked():  # can be unlock if we are at a new block
-            self.proposal_lock.release(if_block=block)
-        log.debug('added transaction', num_txs=self.chain.head_candidate.num_transactions())
-        return success
+        log.debug('add_transaction', lock=self.proposal_lock, tx=tx)
+        self.recent_transactions.update(tx.hash, tx)
+        if tx.hash in self.broadcast_filter or tx.hash in self.transaction_pool:
+            log.debug('discarding known tx')
+            return False
+        try:
+            validate_transaction(self.chain.head_candidate, tx,
+                                 max_nonce_gap=self.transaction_pool.max_per_sender)
+        except InvalidTransaction as e:
+            log.debug('invalid tx', error=e)
+            return False
+        if origin is not None and not self.is_mining:
+            log.debug('discarding tx', mining=self.is_mining)
+            self.broadcast_transaction(tx, origin=origin)
+            return False
+        if not self.transaction_pool.add(tx):
+            return False
+        self.broadcast_transaction(tx, origin=origin)
+        return True
+
+    def apply_pending_transactions(self):
+        "applies the ready txs of the transaction_pool, unless a proposal is in flight"
+        num_applied = 0
+        self.add_transaction_lock.acquire()  # may wait for a block being linked or committed
+        try:
+            # check after acquiring, a proposal could have been made meanwhile
+            if self.proposal_lock.is_locked() or \
+                    hasattr(self.chain.head_candidate, 'should_be_locked'):
+                log.debug('proposal in flight, txs stay pooled', pool=self.transaction_pool)
+                return
+            block = self.proposal_lock.block
+            self.proposal_lock.acquire()
+            try:
+                # mutated below, so verify it on commit unless it is proposed by mk_proposal
+                self.chain.head_candidate.__dict__.pop('is_executed', None)
+                failed = set()  # senders whose following txs can not be applied
+                for tx in self.transaction_pool.ready(self.chain.head_candidate.get_nonce):
+                    if tx.sender in failed:
+                        continue
+                    success = self.chain.add_transaction(tx)
+                    if success:
+                        num_applied += 1
+                    elif success is False:  # e.g. not enough gas left in the block
+                        failed.add(tx.sender)
+                        if self._is_applicable(tx):
+                            continue  # stays pooled for the next block
+                    self.transaction_pool.remove(tx)  # applied, known or invalid
+            finally:
+                if self.proposal_lock.is_locked():  # can be unlock if we are at a new block
+                    self.proposal_lock.release(if_block=block)
+        finally:
+            self.add_transaction_lock.release()
+        log.debug('applied transactions', num=num_applied, pool=self.transaction_pool,
+                  num_txs=self.chain.head_candidate.num_transactions())
+        if num_applied:
+            self._on_new_head_candidate()
+
+    def _is_applicable(self, tx):
+        "True if tx is valid against the state of the head_candidate, if not in this block"
+        try:
+            return validate_transaction(self.chain.head_candidate, tx)
+        except InvalidTransaction as e:
+            log.debug('dropping invalid tx', tx=tx, error=e)
+            return False
 
     def _on_new_head(self, blk):
         self.release_proposal_lock(blk)
+        self.transaction_pool.prune(self.chain.head_candidate.get_nonce)
         super(ChainService, self)._on_new_head(blk)
+        if len(self.transaction_pool):  # the txs which arrived while a proposal was in flight
+            self.setup_alarm(0, self.apply_pending_transactions)
 
     def set_proposal_lock(self, blk):
         log.debug('set_proposal_lock', locked=self.proposal_lock)
@@ -367,11 +654,12 @@ class ChainService(eth_ChainService):
         "receives rlp.decoded serialized"
         log.debug('----------------------------------')
         log.debug('remote_transactions_received', count=len(transactions), remote_id=proto)
+        for tx in transactions:
+            proto.known_transactions.update(tx.hash)
+            self.recent_transactions.update(tx.hash, tx)
 
-        def _add_txs():
-            for tx in transactions:
-                self.add_transaction(tx, origin=proto)
-        gevent.spawn(_add_txs)  # so the locks in add_transaction won't lock the connection
+        # so the locks in add_transactions won't lock the connection
+        gevent.spawn(self.add_transactions, transactions, origin=proto)
 
     # blocks / proposals ################
 
@@ -401,6 +689,7 @@ class ChainService(eth_ChainService):
         self.consensus_manager.synchronizer.receive_blockproposals(proposals)
 
     def on_receive_newblockproposal(self, proto, proposal):
+        self.add_known_messages(proto, proposal)
         if proposal.hash in self.broadcast_filter:
             return
         log.debug('----------------------------------')
@@ -412,9 +701,110 @@ class ChainService(eth_ChainService):
         isvalid = self.consensus_manager.add_proposal(proposal, proto)
         if isvalid:
             self.broadcast(proposal, origin=proto)
-        self.consensus_manager.process()
+        self.consensus_manager.schedule_process()
+
+    def on_receive_compactproposal(self, proto, proposal):
+        log.debug('----------------------------------')
+        log.debug("recv compactproposal", proposal=proposal, remote_id=proto)
+        for tx in proposal.transactions:
+            self.recent_transactions.update(tx.hash, tx)
+        for txhash in proposal.transaction_hashes:  # the peer has all txs of the block
+            proto.known_transactions.update(txhash)
+        missing = proposal.missing_transactions(self.recent_transactions)
+        if missing:
+            if not self.is_valid_compact_proposal(proposal):
+                log.warn('invalid compact proposal', proposal=proposal, remote_id=proto,
+                         FIXME='ban node')
+                return
+            if not self.add_pending_proposal(proto, proposal):
+                return
+            log.debug('requesting missing txs', num=len(missing), remote_id=proto)
+            proto.send_getblocktransactions(proposal.blockhash, missing)
+            return
+        self.add_compact_proposal(proto, proposal)
+
+    def is_valid_compact_proposal(self, p):
+        """
+        The checks of ConsensusManager.add_proposal which can be done without the txs,
+        the signature covers the block, so the proposer is told by the coinbase.
+        """
+        cm = self.consensus_manager
+        if p.height < cm.height or not cm.in_vote_window(p):
+            return False
+        if p.header.number != p.height or \
+                p.header.coinbase != self.consensus_contract.proposer(p.height, p.round):
+            return False
+        lockset = p.round_lockset or p.signing_lockset
+        if not lockset.is_valid or lockset.height != (p.height if p.round else p.height - 1):
+            return False
+        if p.round and lockset.round != p.round - 1:
+            return False
+        if not p.signing_lockset.has_quorum:
+            return False
+        verify_senders(list(p.signing_lockset) + list(p.round_lockset))
+        try:
+            return all(self.consensus_contract.isvalidator(v.sender)
+                       for v in itertools.chain(p.signing_lockset, p.round_lockset))
+        except InvalidSignature:
+            return False
+
+    def add_pending_proposal(self, proto, proposal):
+        """
+        Buffers the proposal until proto sent its missing txs. Proposals of past rounds
+        are dropped, the number buffered is limited per peer and in total.
+        """
+        cm = self.consensus_manager
+        for blockhash, (_, p) in self.pending_proposals.items():
+            if (p.height, p.round) < (cm.height, cm.round):
+                del self.pending_proposals[blockhash]
+        if proposal.blockhash in self.pending_proposals:
+            log.debug('txs already requested', proposal=proposal, remote_id=proto)
+            return False
+        num_from_peer = sum(1 for peer, _ in self.pending_proposals.values() if peer is proto)
+        if num_from_peer >= self.max_pending_proposals_per_peer or \
+                len(self.pending_proposals) >= self.max_pending_proposals:
+            log.warn('too many pending proposals', proposal=proposal, remote_id=proto,
+                     num_from_peer=num_from_peer, num=len(self.pending_proposals))
+            return False
+        self.pending_proposals[proposal.blockhash] = (proto, proposal)
+        return True
+
+    def on_receive_getblocktransactions(self, proto, blockhash, transaction_hashes):
+        log.debug('----------------------------------')
+        log.debug("recv getblocktransactions", num=len(transaction_hashes), remote_id=proto)
+        txs = [self.recent_transactions[h] for h in transaction_hashes
+               if h in self.recent_transactions]
+        proto.send_blocktransactions(blockhash, txs)
+
+    def on_receive_blocktransactions(self, proto, blockhash, transactions):
+        log.debug('----------------------------------')
+        log.debug("recv blocktransactions", num=len(transactions), remote_id=proto)
+        peer, proposal = self.pending_proposals.get(blockhash, (None, None))
+        if peer is not proto:  # only the peer which was asked answers
+            log.debug('unrequested txs', remote_id=proto)
+            return
+        del self.pending_proposals[blockhash]
+        for tx in transactions:
+            self.recent_transactions.update(tx.hash, tx)
+        if proposal.missing_transactions(self.recent_transactions):
+            log.warn('missing txs', proposal=proposal, remote_id=proto)
+            return
+        self.add_compact_proposal(proto, proposal)
+
+    def add_compact_proposal(self, proto, compact):
+        "rebuilds the BlockProposal and handles it like a received one"
+        try:
+            proposal = compact.to_proposal(self.recent_transactions)
+        except InvalidProposalError as e:
+            log.warn('invalid proposal', error=e, FIXME='ban node')
+            return
+        # relay the payload as received
+        proposal._compact_proposal = compact
+        proposal._payload_hash = compact._payload_hash
+        self.on_receive_newblockproposal(proto, proposal)
 
     def on_receive_votinginstruction(self, proto, votinginstruction):
+        self.add_known_messages(proto, votinginstruction)
         if votinginstruction.hash in self.broadcast_filter:
             return
         log.debug('----------------------------------')
@@ -424,12 +814,13 @@ class ChainService(eth_ChainService):
         if isvalid:
             self.broadcast(votinginstruction, origin=proto)
 
-        self.consensus_manager.process()
+        self.consensus_manager.schedule_process()
 
     #  votes
 
     def on_receive_vote(self, proto, vote):
         self.consensus_manager.log('on_receive_vote', v=vote)
+        self.add_known_messages(proto, vote)
         if vote.hash in self.broadcast_filter:
             log.debug('filtered!!!')
             return
@@ -438,23 +829,46 @@ class ChainService(eth_ChainService):
         isvalid = self.consensus_manager.add_vote(vote, proto)
         if isvalid:
             self.broadcast(vote, origin=proto)
-        self.consensus_manager.process()
+        self.consensus_manager.schedule_process()
+
+    def on_receive_votes(self, proto, votes):
+        log.debug('----------------------------------')
+        log.debug("recv votes", num=len(votes), remote_id=proto)
+        verify_senders(votes)
+        for vote in votes:  # an invalid vote does not spoil the others
+            try:
+                sender = vote.sender
+            except InvalidSignature:
+                sender = None
+            if not sender or not self.consensus_contract.isvalidator(sender):
+                log.warn('invalid vote', height=vote.height, round=vote.round, remote_id=proto,
+                         FIXME='ban node')
+                continue
+            self.add_known_messages(proto, vote)
+            if vote.hash in self.broadcast_filter:
+                continue
+            if self.consensus_manager.add_vote(vote, proto):
+                self.broadcast(vote, origin=proto)
+        self.consensus_manager.schedule_process()
 
     def on_receive_ready(self, proto, ready):
+        self.add_known_messages(proto, ready)
         if ready.hash in self.broadcast_filter:
             return
         log.debug('----------------------------------')
         log.debug("recv ready", ready=ready, remote_id=proto)
         self.consensus_manager.add_ready(ready, proto)
         self.broadcast(ready, origin=proto)
-        self.consensus_manager.process()
+        self.consensus_manager.schedule_process()
 
     #  start
 
     def on_receive_status(self, proto, eth_version, network_id, genesis_hash, current_lockset):
         log.debug('----------------------------------')
         log.debug('status received', proto=proto, eth_version=eth_version)
-        assert eth_version == proto.version, (eth_version, proto.version)
+        if eth_version != proto.version:  # the negotiated version is proto.peer_version
+            log.warn("unsupported protocol version", remote_version=eth_version)
+            raise HDCProtocolError('unsupported protocol version')
         if network_id != self.config['eth'].get('network_id', proto.network_id):
             log.warn("invalid network id", remote_network_id=network_id,
                      expected_network_id=self.config['eth'].get('network_id', proto.network_id))
@@ -466,10 +880,16 @@ class ChainService(eth_ChainService):
             raise HDCProtocolError('wrong genesis block')
 
         assert isinstance(current_lockset, LockSet)
+        self.add_known_messages(proto, current_lockset)
         if len(current_lockset):
             log.debug('adding received lockset', ls=current_lockset)
-            for v in current_lockset.votes:
-                self.consensus_manager.add_vote(v, proto)
+            if self.is_valid_lockset(current_lockset):
+                # tells how far ahead the network is, e.g. to a node syncing from far
+                # behind, so it is added beyond the vote window
+                self.consensus_manager.add_lockset(current_lockset)
+            else:
+                for v in current_lockset.votes:
+                    self.consensus_manager.add_vote(v, proto)
 
         self.consensus_manager.process()
 
@@ -485,18 +905,43 @@ class ChainService(eth_ChainService):
             log.debug("sending transactions", remote_id=proto)
             proto.send_transactions(*transactions)
 
+    def is_valid_lockset(self, ls):
+        "if ls is valid with the validators and number of eligible votes of its height"
+        contract = self.consensus_contract
+        if not ls.is_valid or ls.num_eligible_votes != contract.num_eligible_votes(ls.height):
+            return False
+        try:
+            return all(contract.isvalidator(v.sender) for v in ls)
+        except InvalidSignature:
+            return False
+
+    def broadcast_filter_size(self, num_validators):
+        "the configured size or enough for votes, ready messages and a proposal per round"
+        size = self.config['hdc'].get('broadcast_filter_size')
+        if size:
+            return size
+        per_round = 2 * num_validators + 1
+        return max(1024, per_round * self.broadcast_filter_rounds)
+
     def on_wire_protocol_start(self, proto):
         log.debug('----------------------------------')
         log.debug('on_wire_protocol_start', proto=proto)
         assert isinstance(proto, self.wire_protocol)
+        proto.known_messages.max_items = self.broadcast_filter.max_items
+        proto.payload_filter = self.payload_filter
+        self.peer_protocols.add(proto)
         # register callbacks
         proto.receive_status_callbacks.append(self.on_receive_status)
         proto.receive_transactions_callbacks.append(self.on_receive_transactions)
         proto.receive_blockproposals_callbacks.append(self.on_receive_blockproposals)
         proto.receive_getblockproposals_callbacks.append(self.on_receive_getblockproposals)
         proto.receive_newblockproposal_callbacks.append(self.on_receive_newblockproposal)
+        proto.receive_compactproposal_callbacks.append(self.on_receive_compactproposal)
+        proto.receive_getblocktransactions_callbacks.append(self.on_receive_getblocktransactions)
+        proto.receive_blocktransactions_callbacks.append(self.on_receive_blocktransactions)
         proto.receive_votinginstruction_callbacks.append(self.on_receive_votinginstruction)
         proto.receive_vote_callbacks.append(self.on_receive_vote)
+        proto.receive_votes_callbacks.append(self.on_receive_votes)
         proto.receive_ready_callbacks.append(self.on_receive_ready)
 
         # send status
@@ -507,6 +952,15 @@ class ChainService(eth_ChainService):
         assert isinstance(proto, self.wire_protocol)
         log.debug('----------------------------------')
         log.debug('on_wire_protocol_stop', proto=proto)
+        self.peer_protocols.discard(proto)
+        self.tx_buffers.pop(proto, None)
+
+    def add_known_messages(self, proto, obj):
+        "remember that the peer has obj and the votes contained in it"
+        verify_senders(obj)
+        for o in signed_messages([obj]):
+            if o._sender:  # skip invalid signatures
+                proto.known_messages.update(o.hash)
 
     def broadcast(self, obj, origin=None):
         """
@@ -514,15 +968,85 @@ class ChainService(eth_ChainService):
         fmap = {BlockProposal: 'newblockproposal', VoteBlock: 'vote', VoteNil: 'vote',
                 VotingInstruction: 'votinginstruction', Transaction: 'transactions',
                 Ready: 'ready'}
+        if isinstance(obj, Signed) and obj._payload_hash:
+            self.payload_filter.update(obj._payload_hash)
         if self.broadcast_filter.update(obj.hash) is False:
             log.debug('already broadcasted', obj=obj)
             return
         if isinstance(obj, BlockProposal):
             assert obj.sender == obj.block.header.coinbase
         log.debug('broadcasting', obj=obj, origin=origin)
+        exclude_peers = [origin.peer] if origin else []
+        if isinstance(obj, Signed):  # skip peers which already have it
+            for proto in self.peer_protocols:
+                if proto.known_messages.update(obj.hash) is False:
+                    exclude_peers.append(proto.peer)
+        if isinstance(obj, Transaction):
+            return self.buffer_transaction(obj, origin)
+        if isinstance(obj, BlockProposal):
+            return self.broadcast_proposal(obj, exclude_peers)
+        if isinstance(obj, (VoteBlock, VoteNil)) and self.vote_coalescing_window:
+            if not self.vote_buffer:
+                self.setup_alarm(self.vote_coalescing_window, self.flush_votes)
+            self.vote_buffer.append((obj, exclude_peers))
+            return
         bcast = self.app.services.peermanager.broadcast
-        bcast(HDCProtocol, fmap[type(obj)], args=(obj,),
-              exclude_peers=[origin.peer] if origin else [])
+        bcast(HDCProtocol, fmap[type(obj)], args=(obj,), exclude_peers=exclude_peers)
+
+    def flush_votes(self):
+        "sends the buffered votes, one packet per peer if it supports the votes command"
+        buffered, self.vote_buffer = self.vote_buffer, []
+        for proto in list(self.peer_protocols):
+            votes = [v for v, exclude_peers in buffered if proto.peer not in exclude_peers]
+            if len(votes) > 1 and proto.peer_version >= proto.votes_version:
+                proto.send_votes(*votes)
+            else:
+                for v in votes:
+                    proto.send_vote(v)
+
+    def broadcast_proposal(self, proposal, exclude_peers=[]):
+        "sends the proposal as CompactBlockProposal to the peers supporting it"
+        if self.tx_buffers:  # so the peers have the txs before the proposal
+            self.flush_transactions()
+        for proto in list(self.peer_protocols):
+            if proto.peer in exclude_peers:
+                continue
+            if proto.peer_version >= proto.compact_proposal_version:
+                proto.send_compactproposal(self.compact_proposal(proposal))
+            else:
+                proto.send_newblockproposal(proposal)
+
+    def compact_proposal(self, proposal):
+        "the CompactBlockProposal which includes the txs not known to all peers"
+        if proposal._compact_proposal is None:
+            def is_known(txhash):
+                return all(txhash in p.known_transactions for p in self.peer_protocols)
+            proposal._compact_proposal = CompactBlockProposal.from_proposal(proposal, is_known)
+        return proposal._compact_proposal
+
+    def buffer_transaction(self, tx, origin=None):
+        "adds tx to the buffers of the peers which don't know it yet"
+        for proto in self.peer_protocols:
+            if proto is origin or proto.known_transactions.update(tx.hash) is False:
+                continue
+            txs = self.tx_buffers.setdefault(proto, [])
+            txs.append(tx)
+            if len(txs) >= self.tx_flush_size:
+                self.flush_transactions(proto)
+        if self.tx_buffers and not self.tx_flush_pending:
+            self.tx_flush_pending = True
+            self.setup_alarm(self.tx_flush_interval, self.flush_transactions)
+
+    def flush_transactions(self, proto=None):
+        "sends the buffered txs of proto or of all peers, one packet per peer"
+        if proto is None:
+            self.tx_flush_pending = False
+            buffers, self.tx_buffers = self.tx_buffers, dict()
+        else:
+            buffers = {proto: self.tx_buffers.pop(proto)}
+        for proto, txs in buffers.items():
+            log.debug('sending txs', num=len(txs), remote_id=proto)
+            proto.send_transactions(*txs)
 
     broadcast_transaction = broadcast
 
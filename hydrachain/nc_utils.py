@@ -27,7 +27,8 @@ def transact(app, sender, to_, value=0, data=''):
     head_candidate = app.services.chain.chain.head_candidate
     default_gasprice = 1
     default_startgas = head_candidate.gas_limit - head_candidate.gas_used
-    nonce = head_candidate.get_nonce(sender)
+    pool = app.services.chain.transaction_pool  # pending txs of sender follow the account nonce
+    nonce = pool.next_nonce(sender, head_candidate.get_nonce(sender))
     tx = transactions.Transaction(nonce=nonce, gasprice=default_gasprice,
                                   startgas=default_startgas, to=to_, value=value, data=data)
     assert sender in app.services.accounts, 'no account for sender'
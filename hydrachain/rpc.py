@@ -0,0 +1,68 @@
+import rlp
+from ethereum.exceptions import InvalidTransaction
+from ethereum.slogging import get_logger
+from ethereum.transactions import Transaction
+from pyethapp import jsonrpc
+from pyethapp.jsonrpc import public, Subdispatcher, BadRequestError
+from pyethapp.jsonrpc import address_decoder, data_decoder, data_encoder, quantity_encoder
+
+log = get_logger('hdc.jsonrpc')
+
+
+class Chain(jsonrpc.Chain):
+
+    @public
+    def sendTransaction(self, data):
+        """
+        extend spec to support v,r,s signed transactions,
+        without a nonce the one following the sender's txs in the transaction_pool is used
+        """
+        if isinstance(data, dict) and not data.get('v') and not data.get('nonce'):
+            chainservice = self.app.services.chain
+            if 'from' in data:
+                sender = address_decoder(data['from'])
+            else:
+                sender = self.app.services.accounts.coinbase
+            nonce = chainservice.chain.head_candidate.get_nonce(sender)
+            data = dict(data, nonce=quantity_encoder(
+                chainservice.transaction_pool.next_nonce(sender, nonce)))
+        return super(Chain, self).sendTransaction(data)
+
+
+class HDC(Subdispatcher):
+
+    """HydraChain specific methods"""
+
+    prefix = 'hdc_'
+    required_services = ['chain']
+
+    max_transactions = 1024  # per call
+
+    @public
+    def sendRawTransactions(self, data):
+        """
+        Adds a list of signed, rlp encoded transactions in one batch.
+        Returns per tx its hash if it was accepted, otherwise None.
+        """
+        if not isinstance(data, list):
+            raise BadRequestError('Transactions must be a list')
+        if len(data) > self.max_transactions:
+            raise BadRequestError('Too many transactions (max %d)' % self.max_transactions)
+        txs = []
+        for d in data:
+            try:
+                txs.append(rlp.decode(data_decoder(d), Transaction))
+            except (BadRequestError, rlp.RLPException, InvalidTransaction) as e:
+                log.debug('invalid raw tx', error=e)
+                txs.append(None)
+        results = iter(self.chain.add_transactions([tx for tx in txs if tx is not None]))
+        return [data_encoder(tx.hash) if tx is not None and next(results) else None
+                for tx in txs]
+
+
+class JSONRPCServer(jsonrpc.JSONRPCServer):
+
+    @classmethod
+    def subdispatcher_classes(cls):
+        subdispatchers = super(JSONRPCServer, cls).subdispatcher_classes()
+        return tuple(Chain if s is jsonrpc.Chain else s for s in subdispatchers) + (HDC,)
@@ -0,0 +1,65 @@
+"""Microbenchmark for signing and recovering votes.
+
+Compares creating a libsecp256k1 context per operation (as Signed did before)
+with the contexts shared via hydrachain.consensus.base.contexts.
+
+    >>> python -m hydrachain.tests.sigperf [num_votes]
+
+Every vote signs a distinct message, so recovering the senders does not hit the
+sender_cache.
+
+"""
+import time
+
+from secp256k1 import PrivateKey, PublicKey, ALL_FLAGS
+from hydrachain.consensus import base
+from hydrachain.consensus.base import VoteBlock, contexts, sender_cache
+
+
+class FreshContexts(base.Secp256k1Contexts):
+
+    "creates a new context for every key, i.e. the behaviour before shared contexts"
+
+    def private_key(self, privkey):
+        return PrivateKey(privkey, raw=True)
+
+    def public_key(self):
+        return PublicKey(flags=ALL_FLAGS)
+
+
+def run(num_votes, privkeys):
+    votes = [VoteBlock(i + 1, 0, '0' * 32) for i in range(num_votes)]
+    st = time.time()
+    for i, v in enumerate(votes):
+        v.sign(base.contexts.private_key(privkeys[i % len(privkeys)]))
+    sign_elapsed = time.time() - st
+
+    sender_cache.clear()
+    for v in votes:
+        v._sender = None
+    st = time.time()
+    for v in votes:
+        assert v.sender
+    recover_elapsed = time.time() - st
+    assert not sender_cache.hits, sender_cache
+    return num_votes / sign_elapsed, num_votes / recover_elapsed
+
+
+def main(num_votes):
+    privkeys = [chr(i) * 32 for i in range(1, 11)]
+    results = []
+    for name, ctxs in (('fresh contexts', FreshContexts()), ('shared contexts', contexts)):
+        base.contexts = ctxs
+        try:
+            signed, recovered = run(num_votes, privkeys)
+        finally:
+            base.contexts = contexts
+        results.append((name, signed, recovered))
+        print '%-16s signed/s: %8.0f  recovered/s: %8.0f' % (name, signed, recovered)
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    num_votes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    main(num_votes)
@@ -3,9 +3,13 @@ from hydrachain.consensus.base import Vote, VoteBlock, VoteNil, LockSet, ishash,
 from hydrachain.consensus.base import DoubleVotingError, InvalidVoteError, MissingSignatureError
 from hydrachain.consensus.base import BlockProposal, genesis_signing_lockset, InvalidProposalError
 from hydrachain.consensus.base import Proposal, VotingInstruction, InvalidSignature, Signed
+from hydrachain.consensus.base import SenderCache, sender_cache, verify_senders, CompactLockSet
+from hydrachain.consensus.base import TransientBlock, CompactBlockProposal
+from hydrachain.consensus import base
 
 
 from ethereum import utils, tester
+from ethereum.transactions import Transaction
 import rlp
 import pytest
 
@@ -25,6 +29,32 @@ def test_signed():
     assert s.hash == h
 
 
+def test_signed_caches():
+    v = VoteBlock(2, 3, '0' * 32)
+    assert v._cached_rlp is None  # not signed
+    v.sign(privkey)
+    assert v._cached_rlp is None  # rawhash and hash don't encode it
+    rawhash, h = v.rawhash, v.hash
+    assert v._cached_rlp is None
+    data = v.encode()
+    assert v.rawhash is rawhash and v.hash is h and v.encode() is data
+    assert rlp.encode(v) is data
+    d = rlp.decode(data, Vote)
+    assert d == v and d._cached_rlp is data
+
+    # changing the content drops the caches and the sender
+    v.blockhash = '1' * 32
+    assert v.rawhash != rawhash
+    assert v.encode() != data
+    assert v.sender != utils.privtoaddr(privkey)
+
+    # decoded messages are immutable
+    d = rlp.decode(data, Vote)
+    assert d.rawhash == rawhash and d.hash == h
+    with pytest.raises(ValueError):
+        d.blockhash = '1' * 32
+
+
 def test_vote():
     h, r = 2, 3
     bh = '0' * 32
@@ -77,6 +107,79 @@ privkeys = [chr(i) * 32 for i in range(1, 11)]
 validators = [utils.privtoaddr(p) for p in privkeys]
 
 
+def test_sender_cache():
+    v = VoteBlock(5, 0, '0' * 32)
+    v.sign(privkeys[0])
+    vs = rlp.encode(v)
+    sender_cache.clear()
+    assert rlp.decode(vs, Vote).sender == validators[0]
+    assert sender_cache.misses == 1 and sender_cache.hits == 0
+    for i in range(3):
+        assert rlp.decode(vs, Vote).sender == validators[0]
+    assert sender_cache.misses == 1 and sender_cache.hits == 3
+
+    # lru eviction
+    c = SenderCache(max_items=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)
+    assert 'b' not in c
+    assert 'a' in c and 'c' in c
+    assert len(c) == 2
+    assert c.get('b') is None
+    assert c.hits == 1 and c.misses == 1
+
+
+def test_verify_senders(monkeypatch):
+    ls = LockSet(num_eligible_votes=len(privkeys))
+    for i, privkey in enumerate(privkeys):
+        v = VoteBlock(2, 0, '0' * 32)
+        v.sign(privkey)
+        ls.add(v)
+    data = rlp.encode(ls)
+
+    sender_cache.clear()
+    votes = [rlp.decode(rlp.encode(vote), Vote) for vote in ls]
+    v = votes[3]
+    votes[3] = Vote(v.height, v.round, v.blockhash, v.v, 0, v.s)  # invalid signature
+    assert not any(v._sender for v in votes)
+    assert verify_senders(votes, votes[:2]) == len(privkeys) - 1  # all recovered once
+    for i, v in enumerate(votes):
+        if i == 3:
+            assert v._sender is None
+            with pytest.raises(InvalidSignature):
+                v.sender
+        else:
+            assert v._sender == validators[i]
+
+    # decoded locksets are verified in one batch
+    sender_cache.clear()
+    d = rlp.decode(data, LockSet)
+    assert sender_cache.misses == len(privkeys)
+    assert [v._sender for v in d] == validators
+    assert verify_senders(d) == 0
+
+    # the votes of a lockset are replaced after their senders were recovered
+    num_votes = []
+    monkeypatch.setattr(base.batch_verifier, 'verify', lambda objs: num_votes.append(len(ls)))
+    ls.votes = votes[:2]
+    assert num_votes == [len(privkeys)]
+    assert len(ls) == 2
+    monkeypatch.undo()
+
+    # transactions
+    txs = [Transaction(0, 1, 21000, tester.a1, 1, '').sign(privkey) for privkey in privkeys]
+    txs = [rlp.decode(rlp.encode(tx), Transaction) for tx in txs]
+    tx = txs[3]
+    txs[3] = Transaction(tx.nonce, tx.gasprice, tx.startgas, tx.to, tx.value, tx.data,
+                         tx.v, 0, tx.s)  # invalid signature
+    assert not any(tx._sender for tx in txs)
+    assert verify_senders(txs) == len(privkeys) - 1
+    assert txs[3]._sender is None
+    assert [t._sender for t in txs[:3] + txs[4:]] == validators[:3] + validators[4:]
+
+
 def test_ready():
     ls = LockSet(num_eligible_votes=len(privkeys))
     s = Ready(0, current_lockset=ls)
@@ -260,6 +363,75 @@ def test_LockSet_quorums():
             assert getattr(ls, method) == getattr(d, method)
 
 
+def test_LockSet_tally():
+    ls = LockSet(len(privkeys))
+    h, r = 2, 1
+    for i, privkey in enumerate(privkeys):
+        v = VoteBlock(h, r, chr(i % 3 + 1) * 32) if i < 7 else VoteNil(h, r)
+        v.sign(privkey)
+        ls.add(v)
+    assert ls.hr == (h, r)
+    assert ls.blockhashes() == [('\x01' * 32, 3), ('\x03' * 32, 2), ('\x02' * 32, 2)]
+    assert ls.leader == ('\x01' * 32, 3)
+    assert ls.has_noquorum
+
+    # replace votes, the tally follows
+    for i in range(6):
+        v = VoteBlock(h, r, '\x03' * 32)
+        v.sign(privkeys[i])
+        ls.add(v, force_replace=True)
+    assert len(ls) == len(privkeys)
+    # identical votes (2, 5) are kept in place, replacements are appended
+    assert ls.signee == [validators[i] for i in (2, 5, 6, 7, 8, 9, 0, 1, 3, 4)]
+    assert ls.blockhashes() == [('\x03' * 32, 6), ('\x01' * 32, 1)]
+    assert ls.has_quorum_possible == '\x03' * 32
+    ls.check()
+
+    # serialization is not affected
+    d = rlp.decode(rlp.encode(ls), LockSet)
+    assert rlp.encode(d) == rlp.encode(ls)
+    assert d.blockhashes() == ls.blockhashes()
+    assert d.leader == ls.leader
+
+
+def test_LockSet_compact():
+    ls = LockSet(len(privkeys))
+    for i, privkey in enumerate(privkeys[:8]):
+        v = VoteBlock(2, 1, chr(i // 4 + 1) * 32) if i < 6 else VoteNil(2, 1)
+        ls.add(v.sign(privkey))
+    data = rlp.encode(ls, CompactLockSet)
+    assert len(data) < len(rlp.encode(ls))
+    d = rlp.decode(data, LockSet)  # both formats are accepted
+    assert d == ls
+    assert rlp.encode(d) == rlp.encode(ls)
+    assert d.signee == ls.signee
+    assert [type(vote) for vote in d] == [type(vote) for vote in ls]
+    assert rlp.decode(rlp.encode(LockSet(1), CompactLockSet), LockSet) == LockSet(1)
+
+    # proposals keep their hash and signature
+    vi = VotingInstruction(2, 2, ls).sign(privkeys[0])
+    d = rlp.decode(rlp.encode(vi, VotingInstruction.compact_sedes()), VotingInstruction)
+    assert d.round_lockset == ls
+    assert d.sender == vi.sender
+    assert d.hash == vi.hash
+
+
+def test_transientblock_lazy():
+    s = tester.state()
+    s.send(tester.k0, tester.a1, 1)
+    s.mine(1)
+    blk = s.blocks[0]  # the tester applies transactions to the genesis block
+    assert len(blk.transaction_list) == 1
+    data = rlp.encode(blk)
+    t = rlp.decode(data, TransientBlock)
+    assert t._transactions_serial is not None  # not decoded yet
+    assert rlp.encode(t, TransientBlock) == data
+    assert t.hash == blk.hash
+    assert t.transaction_list[0].hash == blk.transaction_list[0].hash
+    assert t._transactions_serial is None
+    assert rlp.encode(t, TransientBlock) == data
+
+
 def test_blockproposal():
     s = tester.state()
 
@@ -343,6 +515,54 @@ def test_blockproposal():
         bp = BlockProposal(height=2, round=1, block=blk2, signing_lockset=ls, round_lockset=rls)
 
 
+def test_blockproposal_sign_coinbase():
+    s = tester.state()
+    s.mine(n=1)
+    gls = genesis_signing_lockset(s.blocks[0], privkeys[0])
+    bp = BlockProposal(height=1, round=0, block=s.blocks[1], signing_lockset=gls,
+                       round_lockset=None)
+    with pytest.raises(InvalidProposalError):  # privkey doesnt match coinbase
+        bp.sign(privkeys[0])
+    bp.v = 0
+    bp.sign(tester.k0)
+    assert bp.sender == s.blocks[1].header.coinbase
+
+
+def test_compact_blockproposal():
+    s = tester.state()
+    s.mine(1)
+    s.send(tester.k0, tester.a1, 1)
+    s.send(tester.k0, tester.a2, 1)
+    s.mine(1)
+    genesis, blk1 = s.blocks[0], s.blocks[1]
+    txs = blk1.transaction_list
+    assert len(txs) == 2
+    gls = genesis_signing_lockset(genesis, privkeys[0])
+    bp = BlockProposal(height=1, round=0, block=blk1, signing_lockset=gls, round_lockset=None)
+    bp.sign(tester.k0)
+
+    # only the unknown tx is included
+    cbp = CompactBlockProposal.from_proposal(bp, lambda txhash: txhash == txs[0].hash)
+    assert [tx.hash for tx in cbp.transactions] == [txs[1].hash]
+    data = rlp.encode(cbp)
+    assert len(data) < len(rlp.encode(bp))
+
+    d = rlp.decode(data, CompactBlockProposal)
+    assert d.blockhash == blk1.hash
+    assert d.missing_transactions(dict()) == [txs[0].hash]
+    assert d.missing_transactions({txs[0].hash: txs[0]}) == []
+    dbp = d.to_proposal({txs[0].hash: txs[0]})
+    assert rlp.encode(dbp) == rlp.encode(bp)
+    assert dbp.sender == bp.sender
+    assert dbp.hash == bp.hash
+
+    # txs which do not match the header
+    cbp.transaction_hashes = [txs[1].hash]
+    with pytest.raises(InvalidProposalError) as e:
+        cbp.to_proposal(dict())
+    assert 'tx_list_root' in str(e.value)
+
+
 def test_VotingInstruction():
     rls = LockSet(len(validators))
     bh = '1' * 32
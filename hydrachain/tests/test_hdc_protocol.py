@@ -1,12 +1,17 @@
 import rlp
+from collections import OrderedDict
 from ethereum import tester
 from ethereum import utils
 from devp2p.service import WiredService
 from devp2p.protocol import BaseProtocol
 from devp2p.app import BaseApp
-from hydrachain.consensus.protocol import HDCProtocol
+from devp2p.multiplexer import Packet
+from devp2p.peer import Peer
+from hydrachain.consensus.protocol import HDCProtocol, HDCPeer
 from hydrachain.consensus.base import genesis_signing_lockset, VoteNil, VoteBlock, LockSet
 from hydrachain.consensus.base import VotingInstruction, BlockProposal, TransientBlock
+from hydrachain.consensus.utils import DuplicatesFilter
+from hydrachain.utils import sha3
 
 
 class PeerMock(object):
@@ -148,6 +153,62 @@ def test_votinginstruction():
     _p, vi = cb_data.pop()
     assert vi == bp
 
+    # compact locksets if the peer supports them
+    proto.peer_version = proto.compact_lockset_version
+    proto.send_votinginstruction(bp)
+    compact_packet = peer.packets.pop()
+    assert len(compact_packet.payload) < len(packet.payload)
+    proto._receive_votinginstruction(compact_packet)
+    _p, vi = cb_data.pop()
+    assert vi == bp
+    assert vi.round_lockset == round_lockset
+
+
+def test_payload_filter():
+    peer, proto, chain, cb_data, cb = setup()
+    proto.payload_filter = DuplicatesFilter()
+
+    def list_cb(proto, vote):
+        cb_data.append((proto, vote))
+    proto.receive_vote_callbacks.append(list_cb)
+
+    v = VoteBlock(1, 0, '0' * 32)
+    v.sign(privkeys[0])
+    proto.send_vote(v)
+    packet = peer.packets.pop()
+    proto.receive_packet(packet)
+    _p, data = cb_data.pop()
+    assert data == v
+    assert data._payload_hash == sha3(packet.payload)
+
+    # known payloads are dropped before decoding
+    proto.payload_filter.update(data._payload_hash)
+    proto.receive_packet(packet)
+    assert not cb_data
+
+
+def test_relay():
+    peer, proto, chain, cb_data, cb = setup()
+    proto.peer_version = proto.compact_lockset_version
+    chain.mine(n=1)
+    bp = create_proposal(chain.blocks[1])
+
+    # encoded once per format
+    packet = proto.create_newblockproposal(bp)
+    assert proto.create_newblockproposal(bp).payload is packet.payload
+    proto.peer_version = proto.min_version
+    assert proto.create_newblockproposal(bp).payload != packet.payload
+
+    # received payloads are relayed as they are
+    proto.peer_version = proto.compact_lockset_version
+    proto.receive_newblockproposal_callbacks.append(
+        lambda proto, proposal: cb_data.append(proposal))
+    payload = str(packet.payload)
+    proto.receive_packet(Packet(proto.protocol_id, packet.cmd_id, payload))
+    p = cb_data.pop()
+    assert p == bp
+    assert proto.create_newblockproposal(p).payload is payload
+
 
 def test_getblockproposals():
     peer, proto, chain, cb_data, cb = setup()
@@ -190,3 +251,51 @@ def test_vote():
     _p, data = cb_data.pop()
     assert data == payload
     assert isinstance(data, VoteNil)
+
+
+def test_version_negotiation():
+    "a node of version 1 (plain devp2p Peer) connects to an HDCPeer"
+
+    class HDCService(WiredService):
+        name = 'hdc'
+        wire_protocol = HDCProtocol
+
+        def on_wire_protocol_start(self, proto):
+            pass
+
+    class PeerManagerMock(object):
+        config = dict()
+
+        def __init__(self):
+            self.wired_services = [HDCService(BaseApp())]
+
+        def on_hello_received(self, *args):
+            return True
+
+    class MuxMock(object):
+        remote_pubkey = None
+
+        def add_protocol(self, protocol_id):
+            pass
+
+    def mk_peer(klass):
+        peer = klass.__new__(klass)  # without a connection
+        peer.peermanager = PeerManagerMock()
+        peer.config = peer.peermanager.config
+        peer.protocols = OrderedDict()
+        peer.mux = MuxMock()
+        peer.remote_pubkey_available = False
+        return peer
+
+    def connect(a, b):
+        for peer, remote in ((a, b), (b, a)):
+            peer.receive_hello(None, 5, '', remote.capabilities, 30303, '\x01' * 64)
+        return [peer.protocols.get(HDCProtocol) for peer in (a, b)]
+
+    assert mk_peer(Peer).capabilities == [('hdc', 1)]
+    assert mk_peer(HDCPeer).capabilities[-1] == ('hdc', 1)  # kept by version 1 nodes
+    protos = connect(mk_peer(Peer), mk_peer(HDCPeer))
+    assert all(protos)
+    assert [p.peer_version for p in protos] == [HDCProtocol.min_version] * 2
+    protos = connect(mk_peer(HDCPeer), mk_peer(HDCPeer))
+    assert [p.peer_version for p in protos] == [HDCProtocol.max_version] * 2
@@ -1,16 +1,26 @@
 import tempfile
 
 import ethereum.keys
+import gevent
 import pytest
 import rlp
-from ethereum import utils
+import simpy
+from ethereum import utils, tester
 from ethereum.db import EphemDB
+from ethereum.transactions import Transaction
+from pyethapp import jsonrpc
 from pyethapp.accounts import Account, AccountsService
+from pyethapp.jsonrpc import BadRequestError, data_encoder
 
 from hydrachain import hdc_service
 from hydrachain.consensus import protocol as hdc_protocol
 from hydrachain.consensus.base import (Block, BlockProposal, TransientBlock, InvalidProposalError,
-                                       LockSet, Ready)
+                                       CompactBlockProposal, HDCBlockHeader, LockSet, Ready,
+                                       VoteBlock, VoteNil,
+                                       genesis_signing_lockset)
+from hydrachain.consensus.manager import BlockCandidates
+from hydrachain.consensus.simulation import SimChainService
+from hydrachain.rpc import HDC, JSONRPCServer
 
 
 # reduce key derivation iterations
@@ -82,6 +92,657 @@ def test_broadcast_filter():
     assert not df.update(r)
     assert not df.update(r)
     assert r in df
+    assert (df.hits, df.misses) == (2, 1)
+
+    # bounded, the least recently seen is evicted
+    df = hdc_service.DuplicatesFilter(max_items=3)
+    for i in range(3):
+        df.update(i)
+    assert not df.update(0)  # refreshed
+    assert df.update(3)
+    assert len(df) == 3
+    assert 1 not in df
+    assert 0 in df
+
+
+def test_receive_votes(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    proto = hdc_protocol.HDCProtocol(PeerMock(app), chainservice)
+    chainservice.on_wire_protocol_start(proto)
+    added = []
+    monkeypatch.setattr(chainservice.consensus_manager, 'add_vote',
+                        lambda v, proto: added.append(v) or True)
+    votes = [VoteBlock(1, 0, '1' * 32).sign(privkey) for privkey in privkeys[:2]]
+    bad_signature = VoteBlock(1, 0, '1' * 32).sign(privkeys[2])
+    bad_signature.r = 0
+    not_validator = VoteBlock(1, 0, '1' * 32).sign('\x01' * 32)
+    batch = votes[:1] + [bad_signature, not_validator] + votes[1:]
+    chainservice.on_receive_votes(proto, batch)
+    assert added == votes
+
+
+def test_known_messages(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    protos = [hdc_protocol.HDCProtocol(PeerMock(app), chainservice) for i in range(2)]
+    for proto in protos:
+        chainservice.on_wire_protocol_start(proto)
+    ls = LockSet(len(validators))
+    for privkey in privkeys[:3]:
+        ls.add(VoteBlock(1, 0, '1' * 32).sign(privkey))
+    r = Ready(0, ls).sign(privkeys[1])
+
+    # the peer which sent the Ready also has the votes in it
+    chainservice.add_known_messages(protos[0], r)
+    assert r.hash in protos[0].known_messages
+    assert all(v.hash in protos[0].known_messages for v in ls)
+    assert not len(protos[1].known_messages)
+
+    broadcasts = []
+    monkeypatch.setattr(app.services.peermanager, 'broadcast',
+                        staticmethod(lambda *args, **kargs: broadcasts.append(kargs)))
+    r2 = Ready(1, ls).sign(privkeys[2])
+    chainservice.add_known_messages(protos[0], r2)
+    chainservice.broadcast(r2)
+    assert broadcasts.pop()['exclude_peers'] == [protos[0].peer]
+    assert r2.hash in protos[1].known_messages  # sent to it
+
+    # votes are buffered and sent in one packet per peer
+    packets = [[], []]
+    for proto, sent in zip(protos, packets):
+        proto.peer.send_packet = sent.append
+        proto.peer_version = proto.votes_version
+    votes = [VoteBlock(1, 0, '1' * 32).sign(privkey) for privkey in privkeys[3:5]]
+    for v in ls.votes[:1] + votes:
+        chainservice.broadcast(v)
+    assert not broadcasts and not packets[1]
+    chainservice.flush_votes()
+    assert [p.cmd_id for p in packets[1]] == [hdc_protocol.HDCProtocol.votes.cmd_id]
+    decoded = hdc_protocol.HDCProtocol.votes.decode_payload(packets[1][0].payload)
+    assert list(decoded) == ls.votes[:1] + votes
+    # the first vote is known to the first peer
+    assert len(packets[0]) == 1
+    assert not chainservice.vote_buffer
+
+    # single votes for peers of older versions
+    protos[1].peer_version = protos[1].min_version
+    for v in votes:
+        chainservice.broadcast(v)  # already broadcasted
+    votes = [VoteBlock(1, 0, '1' * 32).sign(privkey) for privkey in privkeys[5:7]]
+    for v in votes:
+        chainservice.broadcast(v)
+    chainservice.flush_votes()
+    assert [p.cmd_id for p in packets[1][1:]] == [hdc_protocol.HDCProtocol.vote.cmd_id] * 2
+
+
+def test_transaction_buffers():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    protos = [hdc_protocol.HDCProtocol(PeerMock(app), chainservice) for i in range(2)]
+    packets = [[], []]
+    for proto, sent in zip(protos, packets):
+        chainservice.on_wire_protocol_start(proto)
+        proto.peer.send_packet = sent.append
+
+    def sent_txs(packet):
+        decoded = hdc_protocol.HDCProtocol.transactions.decode_payload(packet.payload)
+        return [tx.hash for tx in decoded]
+
+    txs = [Transaction(i, 1, 21000, validators[1], 1, '').sign(privkeys[0]) for i in range(5)]
+    protos[0].known_transactions.update(txs[0].hash)  # announced by the peer
+    for tx in txs[:3]:
+        chainservice.broadcast_transaction(tx)
+    assert packets == [[], []]
+    chainservice.flush_transactions()
+    assert [sent_txs(p) for p in packets[0]] == [[tx.hash for tx in txs[1:3]]]
+    assert [sent_txs(p) for p in packets[1]] == [[tx.hash for tx in txs[:3]]]
+
+    # full buffers are sent without waiting
+    chainservice.tx_flush_size = 2
+    for tx in txs[3:]:
+        chainservice.broadcast_transaction(tx)
+    assert sent_txs(packets[1][-1]) == [tx.hash for tx in txs[3:]]
+    assert not chainservice.tx_buffers
+
+
+def test_height_manager_state():
+    cm = hdc_service.ChainService(AppMock(privkeys[0])).consensus_manager
+    hm = cm.heights[1]
+
+    def vote(klass, round_, *args, **kargs):
+        for privkey in privkeys[:kargs.get('num', 7)]:
+            hm.add_vote(klass(1, round_, *args).sign(privkey))
+    assert (hm.last_valid_lockset, hm.last_quorum_lockset, hm.round) == (None, None, 0)
+    vote(VoteNil, 0)
+    assert hm.last_valid_lockset.round == 0 and hm.last_valid_lockset.has_noquorum
+    assert hm.round == 1 and not hm.has_quorum
+    vote(VoteBlock, 2, 'a' * 32, num=5)  # not valid yet
+    assert hm.round == 1
+    vote(VoteBlock, 1, 'a' * 32)
+    assert hm.has_quorum == 'a' * 32
+    assert hm.last_quorum_lockset.round == 1
+    assert cm.highest_committing_lockset == hm.last_quorum_lockset
+    vote(VoteBlock, 2, 'a' * 32)
+    assert hm.last_quorum_lockset.round == hm.last_valid_lockset.round == 2
+    assert hm.round == 3
+    with pytest.raises(SystemExit):  # a quorum on a different block
+        vote(VoteBlock, 3, 'b' * 32)
+
+
+def test_vote_window():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    proto = hdc_protocol.HDCProtocol(PeerMock(app), chainservice)
+    cm = chainservice.consensus_manager
+    heights = len(cm.heights)
+    far = cm.height + cm.max_future_heights + 1
+    assert cm.add_vote(VoteBlock(far, 0, 'a' * 32).sign(privkeys[1]), proto) is None
+    assert cm.add_vote(VoteNil(cm.height, cm.max_future_rounds + 1).sign(privkeys[1]),
+                       proto) is None
+    assert len(cm.heights) == heights and far not in cm.heights
+    assert cm.add_vote(VoteBlock(far - 1, 0, 'a' * 32).sign(privkeys[1]), proto)
+    assert cm.add_vote(VoteBlock(far, 0, 'a' * 32).sign(privkeys[1]))  # e.g. of a lockset
+    assert list(cm.heights)[:2] == [far, far - 1]  # highest first
+    cm.heights.pop(far - 1)
+    assert list(cm.heights)[0] == far and far - 1 not in cm.heights
+
+
+def test_status_from_far_ahead():
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    proto = hdc_protocol.HDCProtocol(PeerMock(app), chainservice)
+    cm = chainservice.consensus_manager
+    far = cm.height + cm.max_future_heights + 10
+    network_id = app.config['eth'].get('network_id', proto.network_id)
+
+    def receive_status(ls):
+        chainservice.on_receive_status(proto, proto.version, network_id,
+                                       chainservice.chain.genesis.hash, ls)
+
+    # a single vote beyond the window is dropped
+    ls = LockSet(len(validators))
+    ls.add(VoteBlock(far, 0, 'a' * 32).sign(privkeys[1]))
+    receive_status(ls)
+    assert far not in cm.heights
+    # a quorum tells a node far behind how far to sync
+    ls = LockSet(len(validators))
+    for privkey in privkeys:
+        ls.add(VoteBlock(far, 0, 'a' * 32).sign(privkey))
+    receive_status(ls)
+    assert cm.highest_committing_lockset == ls
+    assert cm.synchronizer.missing == range(cm.head.number + 1, far + 1)
+    # unless it is a quorum of a wrong number of eligible votes
+    ls = LockSet(1)
+    ls.add(VoteBlock(far + 1, 0, 'a' * 32).sign(privkeys[1]))
+    receive_status(ls)
+    assert far + 1 not in cm.heights
+
+
+def test_block_candidates():
+    class ProposalMock(object):
+
+        def __init__(self, height, blockhash, prevhash):
+            self.height, self.blockhash, self.prevhash = height, blockhash, prevhash
+            self.block = self
+
+    candidates = BlockCandidates()
+    ps = [ProposalMock(1, 'a', 'g'), ProposalMock(2, 'b', 'a'), ProposalMock(2, 'c', 'a'),
+          ProposalMock(3, 'd', 'b')]
+    for p in ps:
+        candidates.add(p)
+    candidates.add(ps[0])
+    assert len(candidates) == 4 and 'a' in candidates
+    assert candidates.children('g') == ps[:1]
+    assert sorted(candidates.children('a')) == sorted(ps[1:3])
+    assert candidates.children('x') == []
+    candidates.prune(2)
+    assert candidates.values() == ps[3:]
+    assert candidates.heights == [3]
+    assert candidates.children('a') == []
+
+
+def test_coalesced_process(monkeypatch):
+    cm = hdc_service.ChainService(AppMock(privkeys[0])).consensus_manager
+    passes = []
+    monkeypatch.setattr(cm, '_process', lambda: passes.append(1))
+    for i in range(5):  # e.g. a burst of votes
+        cm.schedule_process()
+    assert not passes
+    gevent.sleep(0.01)
+    assert len(passes) == 1
+
+    # a synchronous pass makes the scheduled one obsolete
+    cm.schedule_process()
+    cm.process()
+    gevent.sleep(0.01)
+    assert len(passes) == 2
+
+
+def test_serialized_process(monkeypatch):
+    chainservice = hdc_service.ChainService(AppMock(privkeys[0]))
+    cm = chainservice.consensus_manager
+    running, passes = [], []
+
+    def _process():  # waits for the add_transaction_lock, like commit_block or mk_proposal
+        running.append(1)
+        passes.append(len(running))
+        chainservice.add_transaction_lock.acquire()
+        chainservice.add_transaction_lock.release()
+        running.pop()
+    monkeypatch.setattr(cm, '_process', _process)
+    chainservice.add_transaction_lock.acquire()  # e.g. while a block is linked
+    processing = [gevent.spawn(cm.process) for i in range(3)]
+    gevent.sleep(0)
+    chainservice.add_transaction_lock.release()
+    gevent.joinall(processing)
+    assert passes == [1, 1]  # not overlapping, the calls meanwhile ran one more pass
+    monkeypatch.undo()
+
+    # no proposal if the round moved on while waiting for the lock
+    rm = cm.active_round
+    chainservice.add_transaction_lock.acquire()
+    proposing = gevent.spawn(rm.mk_proposal)
+    gevent.sleep(0)
+    for privkey in privkeys:
+        cm.add_vote(VoteNil(cm.height, 0).sign(privkey))
+    assert cm.round == 1
+    chainservice.add_transaction_lock.release()
+    assert proposing.get() is None
+    assert not chainservice.proposal_lock.is_locked()
+
+
+def test_alarms():
+    chainservice = hdc_service.ChainService(AppMock(privkeys[0]))
+    fired = []
+    chainservice.setup_alarm(0.02, fired.append, 'b')
+    chainservice.setup_alarm(0.01, fired.append, 'a')
+    chainservice.setup_alarm(0.015, fired.append, 'c').cancel()
+    gevent.sleep(0.05)
+    assert fired == ['a', 'b']
+    assert not len(chainservice.alarms)
+
+    # transaction alarms leave no callbacks behind, whether cancelled or fired
+    chainservice.min_block_time = 0.01
+    for i in range(3):
+        chainservice.setup_transaction_alarm(fired.append, i).cancel()
+    assert not chainservice.on_new_head_candidate_cbs
+    chainservice.setup_transaction_alarm(fired.append, 'tx')
+    chainservice._on_new_head_candidate()
+    assert not chainservice.on_new_head_candidate_cbs
+    gevent.sleep(0.05)
+    assert fired == ['a', 'b', 'tx']
+
+
+def test_sim_alarms():
+    class SimClock(object):
+        simenv = simpy.Environment()
+        now = property(lambda self: self.simenv.now)
+        start_timer = SimChainService.start_timer.__func__
+        stop_timer = SimChainService.stop_timer.__func__
+
+    clock = SimClock()
+    alarms = hdc_service.Alarms(clock)
+    fired, started = [], []
+    start_timer = clock.start_timer
+    clock.start_timer = lambda delay, cb: started.append(delay) or start_timer(delay, cb)
+    pending = [alarms.add(i, fired.append, i) for i in range(1, 101)]
+    for alarm in pending[:-1]:
+        alarm.cancel()
+    alarms.add(0.5, fired.append, 0.5)  # replaces the timer
+    clock.simenv.run(until=200)
+    assert fired == [0.5, 100]
+    assert len(started) == 3  # not a wakeup per alarm
+
+
+def test_apply_scheduler(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    scheduler = hdc_service.apply_scheduler
+    s = tester.state()
+    for interval, yields in ((0, 0), (1e-9, 2)):  # 0: blocks the hub
+        monkeypatch.setattr(scheduler, 'interval', interval)
+        ran = []
+        gevent.spawn(ran.append, True)
+
+        def apply_txs():
+            s.send(tester.k0, tester.a1, 1)
+            s.send(tester.k0, tester.a1, 1)
+        chainservice.apply_cooperatively('test', apply_txs)
+        assert scheduler.num_yields == yields
+        assert bool(ran) == bool(yields)
+        assert chainservice.hub_blocked_times[-1] > 0
+        gevent.sleep(0)
+    assert len(chainservice.hub_blocked_times) == 2
+
+
+def test_execute_and_commit_block(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    p = chainservice.consensus_manager.active_round.mk_proposal()
+    chainservice.proposal_lock.release()
+    monkeypatch.setattr(hdc_service.apply_scheduler, 'interval', 0)
+    for in_worker in (False, True):
+        monkeypatch.setitem(app.config['hdc'], 'execute_in_worker', in_worker)
+        ran = []
+        gevent.spawn(ran.append, True)
+        t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+        blk = chainservice.link_block(t_block)
+        assert blk.hash == p.block.hash
+        assert bool(ran) == in_worker  # the hub was not blocked
+        assert not chainservice.add_transaction_lock.locked()
+        gevent.sleep(0)
+
+    # the same block relayed by several peers is executed once
+    executed = []
+    execute_block = chainservice.execute_block
+    monkeypatch.setattr(chainservice, 'execute_block',
+                        lambda t_block: executed.append(t_block) or execute_block(t_block))
+    t_block = rlp.decode(rlp.encode(p.block), TransientBlock)
+    linking = [gevent.spawn(chainservice.link_block, t_block) for i in range(3)]
+    gevent.joinall(linking)
+    assert len(executed) == 1
+    assert len(set(g.value for g in linking)) == 1
+    assert not chainservice.linking
+    blk = linking[0].value
+
+    # the executed block is committed without being verified again
+    verified = []
+    monkeypatch.setattr(hdc_service, 'processblock_verify',
+                        lambda block, parent: verified.append(block) or True)
+    assert blk.is_executed
+    assert chainservice.commit_block(blk)
+    assert chainservice.chain.head == blk
+    assert not verified
+    assert not hasattr(blk, 'is_executed')  # the mark is used once
+    blk.is_executed = True
+    with pytest.raises(hdc_service.VerificationFailed):  # executed on another parent
+        hdc_service.verify(blk, blk)
+    chainservice = hdc_service.ChainService(AppMock(privkeys[0]))
+    blk = rlp.decode(rlp.encode(p.block), TransientBlock).to_block(env=chainservice.chain.env)
+    assert chainservice.commit_block(blk)
+    assert verified == [blk]
+
+
+def test_transaction_pool(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    applied = []  # the validator has no balance before the block reward, skip applying
+
+    def add_transaction(tx):
+        applied.append(tx)
+        chainservice.chain.head_candidate.nonce_offset += 1
+        return True
+    monkeypatch.setattr(chainservice.chain, 'add_transaction', add_transaction)
+    head_candidate = chainservice.chain.head_candidate
+    head_candidate.nonce_offset = 0
+    monkeypatch.setattr(head_candidate, 'get_nonce', lambda sender: head_candidate.nonce_offset)
+
+    txs = [Transaction(i, 1, 21000, validators[1], 1, '').sign(privkeys[0]) for i in range(3)]
+    assert chainservice.add_transaction(txs[0])
+    assert applied == txs[:1]
+    assert not len(chainservice.transaction_pool)
+    assert chainservice.add_transaction(txs[0]) is False  # known
+
+    # while a proposal is in flight txs are pooled without waiting for the lock
+    chainservice.proposal_lock.acquire()
+    assert chainservice.add_transaction(txs[2])  # following a pending tx
+    assert chainservice.add_transaction(txs[1])
+    assert len(chainservice.transaction_pool) == 2
+    assert applied == txs[:1]
+    chainservice.proposal_lock.release()
+    chainservice.apply_pending_transactions()
+    assert applied == txs
+    assert not len(chainservice.transaction_pool)
+
+    # txs which can not be applied for now, e.g. as the block is full, stay pooled
+    tx = Transaction(3, 1, 21000, validators[1], 1, '').sign(privkeys[0])
+    monkeypatch.setattr(chainservice.chain, 'add_transaction', lambda tx: False)
+    assert chainservice.add_transaction(tx)
+    chainservice.apply_pending_transactions()
+    assert tx.hash in chainservice.transaction_pool
+    # txs which are invalid against the state are dropped
+    get_balance = head_candidate.get_balance
+    monkeypatch.setattr(head_candidate, 'get_balance', lambda address: 0)
+    chainservice.apply_pending_transactions()
+    assert not len(chainservice.transaction_pool)
+    monkeypatch.setattr(head_candidate, 'get_balance', get_balance)
+    monkeypatch.setattr(chainservice.chain, 'add_transaction', add_transaction)
+
+    # a proposal made while waiting for the add_transaction_lock keeps the txs pooled
+    tx = Transaction(3, 2, 21000, validators[1], 1, '').sign(privkeys[0])
+    chainservice.proposal_lock.acquire()
+    assert chainservice.add_transaction(tx)
+    chainservice.proposal_lock.release()
+    chainservice.add_transaction_lock.acquire()
+    applying = gevent.spawn(chainservice.apply_pending_transactions)
+    gevent.sleep(0)
+    head_candidate.should_be_locked = True  # as done by mk_proposal
+    chainservice.set_proposal_lock(head_candidate)
+    chainservice.add_transaction_lock.release()
+    applying.get()
+    assert applied == txs
+    assert len(chainservice.transaction_pool) == 1
+    assert not chainservice.add_transaction_lock.locked()
+    assert chainservice.proposal_lock.is_locked()
+
+
+def test_add_transactions(monkeypatch):
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    applied = []
+
+    def add_transaction(tx):
+        applied.append(tx)
+        return True
+    monkeypatch.setattr(chainservice.chain, 'add_transaction', add_transaction)
+    monkeypatch.setattr(chainservice.chain.head_candidate, 'get_nonce',
+                        lambda sender: len(applied))
+    locks = []
+    monkeypatch.setattr(chainservice, 'apply_pending_transactions',
+                        lambda f=chainservice.apply_pending_transactions: locks.append(f()))
+
+    txs = [Transaction(i, 1, 21000, validators[1], 1, '').sign(privkeys[0]) for i in range(3)]
+    tx = Transaction(0, 1, 21000, validators[1], 1, '').sign(privkeys[1])
+    invalid = Transaction(tx.nonce, tx.gasprice, tx.startgas, tx.to, tx.value, tx.data,
+                          tx.v, 0, tx.s)  # invalid signature
+    pooled = []
+
+    def add_to_pool(tx, origin, f=chainservice._add_to_pool):
+        pooled.append(tx)
+        return f(tx, origin)
+    monkeypatch.setattr(chainservice, '_add_to_pool', add_to_pool)
+    results = chainservice.add_transactions(list(reversed(txs)) + [invalid, txs[0]])
+    assert results == [True, True, True, False, True]
+    assert pooled == txs  # the duplicate is added once
+    assert applied == txs  # in nonce order
+    assert len(locks) == 1  # applied in one go
+    assert chainservice.add_transactions(txs[:1]) == [False]  # known
+    assert len(locks) == 1
+
+
+def test_rpc_send_raw_transactions(monkeypatch):
+    assert HDC in JSONRPCServer.subdispatcher_classes()
+    assert jsonrpc.Chain not in JSONRPCServer.subdispatcher_classes()
+
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    added = []
+
+    def add_transactions(txs):
+        added.extend(txs)
+        return [tx.nonce != 1 for tx in txs]
+    monkeypatch.setattr(chainservice, 'add_transactions', add_transactions)
+    dispatcher = HDC()
+    dispatcher.chain = chainservice
+    txs = [Transaction(i, 1, 21000, validators[1], 1, '').sign(privkeys[0]) for i in range(3)]
+    raw = [data_encoder(rlp.encode(tx)) for tx in txs]
+    results = dispatcher.sendRawTransactions(raw[:1] + ['0x1234'] + raw[1:])
+    assert results == [data_encoder(txs[0].hash), None, None, data_encoder(txs[2].hash)]
+    assert added == txs
+    with pytest.raises(BadRequestError):
+        dispatcher.sendRawTransactions(raw[0])
+
+
+def mk_compact_proposal_chain():
+    "a BlockProposal at H1 by its proposer and the chainservice of another validator"
+    app = AppMock(privkeys[0])
+    chainservice = hdc_service.ChainService(app)
+    proposer = chainservice.consensus_contract.proposer(1, 0)
+    s = tester.state()
+    s.mine(1, coinbase=proposer)
+    s.send(tester.k0, tester.a1, 1)
+    s.send(tester.k0, tester.a2, 1)
+    s.mine(1)
+    bp = BlockProposal(1, 0, s.blocks[1], genesis_signing_lockset(s.blocks[0], privkeys[0]))
+    bp.sign(privkeys[validators.index(proposer)])
+    return bp, chainservice
+
+
+def test_compact_proposals(monkeypatch):
+    bp, chainservice = mk_compact_proposal_chain()
+    txs = bp.block.transaction_list
+
+    # the proposer: txs known to all peers are referenced by hash
+    app = AppMock(privkeys[0])
+    protos = [hdc_protocol.HDCProtocol(PeerMock(app), chainservice) for i in range(3)]
+    packets = [[], [], []]
+    for proto, sent in zip(protos, packets):
+        chainservice.on_wire_protocol_start(proto)
+        proto.peer.send_packet = sent.append
+        proto.peer_version = proto.max_version
+        proto.known_transactions.update(txs[0].hash)
+    protos[2].peer_version = protos[2].min_version
+    for tx in txs:
+        chainservice.recent_transactions.update(tx.hash, tx)
+    chainservice.broadcast_proposal(bp, exclude_peers=[protos[0].peer])
+    assert not packets[0]
+    assert packets[2][0].cmd_id == hdc_protocol.HDCProtocol.newblockproposal.cmd_id
+    packet, = packets[1]
+    assert packet.cmd_id == hdc_protocol.HDCProtocol.compactproposal.cmd_id
+    assert len(packet.payload) < len(packets[2][0].payload)
+
+    # the receiver requests the tx which is neither included nor in its pool
+    app2 = AppMock(privkeys[1])
+    chainservice2 = hdc_service.ChainService(app2)
+    received = []
+    monkeypatch.setattr(chainservice2, 'on_receive_newblockproposal',
+                        lambda proto, proposal: received.append(proposal))
+    proto = hdc_protocol.HDCProtocol(PeerMock(app2), chainservice2)
+    chainservice2.on_wire_protocol_start(proto)
+    sent = []
+    proto.peer.send_packet = sent.append
+    proto.peer_version = proto.max_version
+    proto.receive_packet(packet)
+    request, = sent
+    assert request.cmd_id == hdc_protocol.HDCProtocol.getblocktransactions.cmd_id
+    assert not received
+
+    protos[1].receive_packet(request)
+    response = packets[1][-1]
+    assert response.cmd_id == hdc_protocol.HDCProtocol.blocktransactions.cmd_id
+    proto.receive_packet(response)
+    p, = received
+    assert p.hash == bp.hash
+    assert p.sender == bp.sender
+    assert all(tx.hash in proto.known_transactions for tx in txs)
+
+
+def test_compact_proposal_transactions(monkeypatch):
+    bp, chainservice = mk_compact_proposal_chain()
+    txs = bp.block.transaction_list
+    other = Transaction(0, 1, 21000, validators[1], 1, '').sign(privkeys[0])
+    received = []
+    monkeypatch.setattr(chainservice, 'on_receive_newblockproposal',
+                        lambda proto, proposal: received.append(proposal))
+    app = AppMock(privkeys[0])
+    protos = [hdc_protocol.HDCProtocol(PeerMock(app), chainservice) for i in range(2)]
+    requests = []
+    for proto in protos:
+        proto.send_getblocktransactions = lambda *args: requests.append(args)
+
+    def receive(proto, compact):
+        chainservice.on_receive_compactproposal(proto, compact)
+        return compact.blockhash in chainservice.pending_proposals
+
+    compact = CompactBlockProposal.from_proposal(bp)
+    compact.transactions = []
+    assert receive(protos[0], compact)
+    assert requests == [(bp.blockhash, [tx.hash for tx in txs])]
+
+    # a partial answer, one by a peer which was not asked and a wrong one are dropped
+    chainservice.on_receive_blocktransactions(protos[1], bp.blockhash, txs)
+    assert bp.blockhash in chainservice.pending_proposals
+    chainservice.on_receive_blocktransactions(protos[0], bp.blockhash, txs[:1] + [other])
+    assert bp.blockhash not in chainservice.pending_proposals
+    assert not received
+
+    # txs which do not rebuild the tx root of the header
+    compact = CompactBlockProposal.from_proposal(bp)
+    compact.transaction_hashes = [tx.hash for tx in txs[:1]]
+    compact.transactions = txs[:1]
+    chainservice.on_receive_compactproposal(protos[0], compact)
+    assert not received
+
+    compact = CompactBlockProposal.from_proposal(bp)
+    chainservice.on_receive_compactproposal(protos[0], compact)
+    p, = received
+    assert p.hash == bp.hash
+
+
+def test_pending_compact_proposals():
+    bp, chainservice = mk_compact_proposal_chain()
+    cm = chainservice.consensus_manager
+    app = AppMock(privkeys[0])
+    protos = [hdc_protocol.HDCProtocol(PeerMock(app), chainservice) for i in range(2)]
+    for proto in protos:
+        proto.send_getblocktransactions = lambda *args: None
+
+    def compact(**fields):
+        c = CompactBlockProposal.from_proposal(bp)
+        c.transactions = []
+        for k, v in fields.items():
+            setattr(c, k, v)
+        return c
+
+    def receive(proto, compact):
+        chainservice.on_receive_compactproposal(proto, compact)
+        return compact.blockhash in chainservice.pending_proposals
+
+    def mk_header(**fields):
+        header = bp.block.header
+        kargs = dict((f, getattr(header, f)) for f, _ in HDCBlockHeader.fields)
+        kargs.update(fields)
+        return HDCBlockHeader(**kargs)
+
+    # not buffered: not by the proposer, beyond the vote window, without a valid lockset
+    other = [a for a in validators if a != bp.block.header.coinbase][0]
+    assert not receive(protos[0], compact(header=mk_header(coinbase=other)))
+    assert not receive(protos[0], compact(height=cm.height + cm.max_future_heights + 1))
+    assert not receive(protos[0], compact(signing_lockset=LockSet(1)))
+    ls = LockSet(1)  # a quorum at the wrong height
+    ls.add(VoteBlock(1, 0, bp.blockhash).sign(privkeys[0]))
+    assert not receive(protos[0], compact(signing_lockset=ls))
+    assert not chainservice.pending_proposals
+
+    # capped per peer and in total
+    chainservice.max_pending_proposals = 3
+    chainservice.max_pending_proposals_per_peer = 2
+    headers = [mk_header(extra_data=str(i)) for i in range(4)]
+    assert receive(protos[0], compact(header=headers[0]))
+    assert receive(protos[0], compact(header=headers[1]))
+    assert not receive(protos[0], compact(header=headers[2]))
+    assert receive(protos[1], compact(header=headers[2]))
+    assert not receive(protos[1], compact(header=headers[3]))
+
+    # expired once the round moved on
+    for privkey in privkeys:
+        cm.add_vote(VoteNil(1, 0).sign(privkey))
+    assert cm.round == 1
+    header = mk_header(coinbase=chainservice.consensus_contract.proposer(1, 1))
+    assert receive(protos[1], compact(header=header, round=1,
+                                      round_lockset=cm.heights[1].last_valid_lockset))
+    assert chainservice.pending_proposals.keys() == [header.hash]
 
 # def receive_blocks(rlp_data, leveldb=False, codernitydb=False):
 #     app = AppMock()
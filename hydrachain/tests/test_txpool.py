@@ -0,0 +1,94 @@
+import pytest
+from ethereum import tester
+from ethereum.exceptions import InvalidNonce, InsufficientBalance
+from ethereum.transactions import Transaction
+from hydrachain.txpool import TransactionPool, validate_transaction
+
+
+def mk_tx(key, nonce, gasprice=1):
+    return Transaction(nonce, gasprice, 21000, tester.a9, 1, '').sign(key)
+
+
+def test_ready_order():
+    pool = TransactionPool()
+    txs0 = [mk_tx(tester.k0, n, gasprice=1) for n in range(3)]
+    txs1 = [mk_tx(tester.k1, n, gasprice=2) for n in range(2)]
+    for tx in reversed(txs0 + txs1):
+        assert pool.add(tx)
+    assert not pool.add(txs0[0])  # known
+    assert len(pool) == 5
+    assert txs0[0].hash in pool
+
+    nonces = {tester.a0: 0, tester.a1: 0}
+    ready = list(pool.ready(nonces.get))
+    assert ready == txs1 + txs0  # higher gasprice first, nonces in order
+    nonces[tester.a0] = 1
+    assert list(pool.ready(nonces.get)) == txs1 + txs0[1:]
+
+    # a nonce gap stops the sender's txs
+    pool.remove(txs0[1])
+    assert list(pool.ready(nonces.get)) == txs1
+    assert pool.next_nonce(tester.a0, 1) == 1
+    assert pool.next_nonce(tester.a1, 0) == 2
+
+    # txs included in a block are pruned
+    nonces = {tester.a0: 3, tester.a1: 1}
+    pool.prune(nonces.get)
+    assert len(pool) == 1
+    assert list(pool.ready(nonces.get)) == txs1[1:]
+
+
+def test_replacement():
+    pool = TransactionPool()
+    tx = mk_tx(tester.k0, 0, gasprice=100)
+    assert pool.add(tx)
+    assert not pool.add(mk_tx(tester.k0, 0, gasprice=100))
+    assert not pool.add(mk_tx(tester.k0, 0, gasprice=109))  # needs replace_gasprice_bump
+    tx2 = mk_tx(tester.k0, 0, gasprice=110)
+    assert pool.add(tx2)
+    assert len(pool) == 1
+    assert tx.hash not in pool
+    assert list(pool.ready(lambda sender: 0)) == [tx2]
+
+
+def test_limits():
+    pool = TransactionPool(max_transactions=4, max_per_sender=3)
+    txs0 = [mk_tx(tester.k0, n, gasprice=2) for n in range(3)]
+    for tx in txs0:
+        assert pool.add(tx)
+    assert not pool.add(mk_tx(tester.k0, 3, gasprice=2))  # max_per_sender
+    tx1 = mk_tx(tester.k1, 0, gasprice=1)
+    assert pool.add(tx1)
+    assert not pool.add(mk_tx(tester.k2, 0, gasprice=1))  # full, pays not more
+    assert pool.lowest() == tx1
+
+    # the cheapest tx is evicted
+    tx2 = mk_tx(tester.k2, 0, gasprice=3)
+    assert pool.add(tx2)
+    assert tx1.hash not in pool
+    assert len(pool) == 4
+
+    # including the following txs of its sender
+    pool.evict(txs0[1])
+    assert txs0[0].hash in pool and txs0[2].hash not in pool
+    assert len(pool) == 2
+    assert pool.add(mk_tx(tester.k1, 0, gasprice=4))
+    assert pool.add(mk_tx(tester.k1, 1, gasprice=4))
+    assert pool.add(mk_tx(tester.k1, 2, gasprice=4))
+    assert txs0[0].hash not in pool
+    assert len(pool) == 4
+
+
+def test_validate_transaction():
+    s = tester.state()
+    blk = s.block
+    assert validate_transaction(blk, mk_tx(tester.k0, 0))
+    assert validate_transaction(blk, mk_tx(tester.k0, 5))  # future nonces are pending
+    with pytest.raises(InvalidNonce):
+        validate_transaction(blk, mk_tx(tester.k0, 5), max_nonce_gap=4)
+    s.send(tester.k0, tester.a1, 1)
+    with pytest.raises(InvalidNonce):
+        validate_transaction(blk, mk_tx(tester.k0, 0))
+    poor = Transaction(0, 1, 21000, tester.a9, 1, '').sign('\x01' * 32)
+    with pytest.raises(InsufficientBalance):
+        validate_transaction(blk, poor)
@@ -0,0 +1,149 @@
+import heapq
+import itertools
+from ethereum.exceptions import (InvalidNonce, InsufficientStartGas, UnsignedTransaction,
+                                 InsufficientBalance, BlockGasLimitReached)
+from ethereum.slogging import get_logger
+log = get_logger('hdc.txpool')
+
+
+def validate_transaction(block, tx, max_nonce_gap=None):
+    """
+    Like ethereum.processblock.validate_transaction, but txs whose nonce follows the nonce
+    of the sender in block are valid as well and the tx needs not fit into the gas left.
+    """
+    if not tx.sender:
+        raise UnsignedTransaction(tx)
+    if block.number >= block.config['HOMESTEAD_FORK_BLKNUM']:
+        tx.check_low_s()
+    nonce = block.get_nonce(tx.sender)
+    if tx.nonce < nonce or (max_nonce_gap is not None and tx.nonce > nonce + max_nonce_gap):
+        raise InvalidNonce('%r nonce:%d account nonce:%d' % (tx, tx.nonce, nonce))
+    if tx.startgas < tx.intrinsic_gas_used:
+        raise InsufficientStartGas('%r startgas:%d intrinsic:%d' % (
+            tx, tx.startgas, tx.intrinsic_gas_used))
+    total_cost = tx.value + tx.gasprice * tx.startgas
+    if block.get_balance(tx.sender) < total_cost:
+        raise InsufficientBalance('%r balance:%d cost:%d' % (
+            tx, block.get_balance(tx.sender), total_cost))
+    if tx.startgas > block.gas_limit:
+        raise BlockGasLimitReached('%r startgas:%d gas_limit:%d' % (
+            tx, tx.startgas, block.gas_limit))
+    return True
+
+
+class TransactionPool(object):
+
+    """
+    Pending transactions which are not yet applied to a block.
+
+    The txs of a sender are kept by nonce. A tx with the nonce of a pending one replaces
+    it, if its gasprice is at least replace_gasprice_bump percent higher. If the pool is
+    full, the tx with the lowest gasprice is evicted together with the following txs of
+    its sender, unless the new tx does not pay more.
+    """
+
+    max_transactions = 8192
+    max_per_sender = 64  # also the max distance to the sender's nonce
+    replace_gasprice_bump = 10  # percent
+
+    def __init__(self, max_transactions=None, max_per_sender=None):
+        self.max_transactions = max_transactions or self.max_transactions
+        self.max_per_sender = max_per_sender or self.max_per_sender
+        self.senders = dict()  # sender: {nonce: tx}
+        self.transactions = dict()  # txhash: tx
+        self._by_gasprice = []  # heap of (gasprice, counter, txhash), removed txs are skipped
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, txhash):
+        return txhash in self.transactions
+
+    def __repr__(self):
+        return '<TransactionPool(txs=%d senders=%d)>' % (len(self), len(self.senders))
+
+    def add(self, tx):
+        "returns True if tx was added"
+        if tx.hash in self.transactions:
+            return False
+        txs = self.senders.get(tx.sender, dict())
+        if tx.nonce in txs:
+            old = txs[tx.nonce]
+            if tx.gasprice * 100 < old.gasprice * (100 + self.replace_gasprice_bump):
+                log.debug('underpriced replacement', tx=tx, old=old)
+                return False
+            self.remove(old)
+        elif len(txs) >= self.max_per_sender:
+            log.debug('too many txs of sender', tx=tx)
+            return False
+        elif len(self.transactions) >= self.max_transactions:
+            lowest = self.lowest()
+            if lowest.gasprice >= tx.gasprice:
+                log.debug('pool full', tx=tx)
+                return False
+            self.evict(lowest)
+        self.senders.setdefault(tx.sender, dict())[tx.nonce] = tx
+        self.transactions[tx.hash] = tx
+        heapq.heappush(self._by_gasprice, (tx.gasprice, next(self._counter), tx.hash))
+        return True
+
+    def remove(self, tx):
+        "removes tx if it is pending"
+        if self.transactions.pop(tx.hash, None) is None:
+            return
+        txs = self.senders[tx.sender]
+        del txs[tx.nonce]
+        if not txs:
+            del self.senders[tx.sender]
+        if len(self._by_gasprice) > 2 * len(self.transactions) + 64:  # drop removed entries
+            self._by_gasprice = [e for e in self._by_gasprice if e[2] in self.transactions]
+            heapq.heapify(self._by_gasprice)
+
+    def lowest(self):
+        "the pending tx with the lowest gasprice"
+        while self._by_gasprice[0][2] not in self.transactions:
+            heapq.heappop(self._by_gasprice)
+        return self.transactions[self._by_gasprice[0][2]]
+
+    def evict(self, tx):
+        "removes tx and the following txs of its sender, which could not be applied anymore"
+        log.debug('evicting', tx=tx)
+        txs = self.senders[tx.sender]
+        for nonce in sorted(n for n in txs if n >= tx.nonce):
+            self.remove(txs[nonce])
+
+    def next_nonce(self, sender, nonce):
+        "the nonce following the pending txs of sender, nonce is the sender's account nonce"
+        txs = self.senders.get(sender, dict())
+        while nonce in txs:
+            nonce += 1
+        return nonce
+
+    def ready(self, get_nonce):
+        """
+        Yields the txs which can be applied in this order, get_nonce(sender) is the
+        account nonce in the block they are applied to. Of the next txs of all senders
+        the one with the highest gasprice comes first.
+        """
+        heap = []
+        for sender, txs in self.senders.items():
+            nonce = get_nonce(sender)
+            if nonce in txs:
+                heap.append((-txs[nonce].gasprice, nonce, sender))
+        heapq.heapify(heap)
+        while heap:
+            _, nonce, sender = heapq.heappop(heap)
+            txs = self.senders.get(sender, dict())
+            if nonce not in txs:  # removed meanwhile
+                continue
+            yield txs[nonce]
+            if nonce + 1 in txs:
+                heapq.heappush(heap, (-txs[nonce + 1].gasprice, nonce + 1, sender))
+
+    def prune(self, get_nonce):
+        "removes the txs whose nonce is below the account nonce, e.g. included in a block"
+        for sender, txs in self.senders.items():
+            nonce = get_nonce(sender)
+            for tx in [tx for n, tx in txs.items() if n < nonce]:
+                self.remove(tx)